@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Deduplicate addresses before geocoding, so each unique address costs one
+baidu request and the result is shared by all the IDs of the address.
+
+An address is canonicalized by:
+    1) NFKC normalization, full-width letters, digits and punctuation become
+       half-width, e.g. "１２号" -> "12号"
+    2) lower case and collapsed whitespace
+The near-duplicate key, only used when asked for, further drops whitespace
+and bracketed remarks, e.g. "济南市经十路 100号(北门)" and "济南市经十路100号"
+share a key. It also merges "1号(东区)" and "1号(西区)", so it should only be
+used when the brackets of the address table are known to be remarks. Other
+punctuation is kept, since separators like "100-2号" tell apart buildings.
+Addresses are grouped by the md5 of the key. The geocode json of one ID of a
+group, either already saved by an earlier run or fetched once, is copied to
+the json file of the other IDs, so geocode_store and the connection tables
+work unchanged.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import unicodedata
+import pandas as pd
+
+
+_WHITESPACE = re.compile(r"\s+")
+_BRACKETS = re.compile(r"[(\[{【（][^)\]}】）]*[)\]}】）]")
+
+
+def normalize_address(address):
+    """
+    Canonicalize full-width characters and whitespace of an address.
+    @Returns: the normalized string, "" for missing address
+    """
+    if not isinstance(address, str):
+        return ""
+    address = unicodedata.normalize("NFKC", address).lower()
+    return _WHITESPACE.sub(" ", address).strip()
+
+
+def address_key(address, near=False):
+    """
+    @Args:
+        address: raw address
+        near: also drop whitespace and bracketed remarks
+    @Returns: md5 hex digest of the canonical address
+    """
+    address = normalize_address(address)
+    if near:
+        address = _WHITESPACE.sub("", _BRACKETS.sub("", address))
+    return hashlib.md5(address.encode("utf-8")).hexdigest()
+
+
+def group_addresses(ids, addresses, near=False):
+    """
+    Group IDs by address key.
+    @Args:
+        ids: array like of location id
+        addresses: array like of address of each id
+        near: see address_key()
+    @Returns:
+        a pandas dataframe with columns [ID, Address, Key, Group], Group is
+        the order of the first appearance of the key
+    """
+    groups = pd.DataFrame({"ID": list(ids), "Address": list(addresses)})
+    groups["Key"] = [address_key(a, near) for a in groups["Address"]]
+    groups["Group"] = pd.factorize(groups["Key"])[0]
+    return groups
+
+
+def geocode_unique(conn, ids, addresses, near=False, **kwargs):
+    """
+    Geocode each unique address once with BaiduAPIConn.batch_get_coordinate()
+    and fan the result out to all IDs.
+    @Args:
+        conn: a baidumapAPI.BaiduAPIConn
+        ids: array like of location id
+        addresses: array like of address of each id
+        near: group near-duplicate addresses too, see address_key()
+        kwargs: see BaiduAPIConn.batch_fetch()
+    @Returns:
+        the report of batch_fetch(), with following extra keys:
+            ids: number of ids
+            unique: number of unique addresses
+            reused: number of addresses that had a json of an earlier run
+            avoided: number of requests saved by the deduplication
+            copied: number of json files copied from their group
+    """
+    groups = group_addresses(ids, addresses, near)
+    exists = [os.path.exists(conn._output_file(i)) for i in groups["ID"]]
+    groups["Exists"] = exists
+    # Representative of each group, an ID that is already geocoded if any
+    first = (groups.sort_values(["Group", "Exists"], ascending=[True, False],
+                                kind="stable")
+                   .drop_duplicates("Group"))
+    todo = first[~first["Exists"]]
+
+    report = conn.batch_get_coordinate(zip(todo["ID"], todo["Address"]),
+                                       **kwargs)
+    failed = set(report["failed_ids"])
+    source = dict(zip(first["Group"], first["ID"]))
+    copied = 0
+    for id, group, exist in zip(groups["ID"], groups["Group"], groups["Exists"]):
+        rep = source[group]
+        if exist or rep == id or rep in failed:
+            continue
+        shutil.copyfile(conn._output_file(rep), conn._output_file(id))
+        copied += 1
+
+    report.update({"ids": len(groups),
+                   "unique": len(first),
+                   "reused": int(first["Exists"].sum()),
+                   "avoided": int((~groups["Exists"]).sum()) - len(todo),
+                   "copied": copied})
+    conn.metrics.count("geocode_avoided", report["avoided"])
+    conn.metrics.log("%i ids, %i unique addresses, %i requests avoided" % (
+        report["ids"], report["unique"], report["avoided"]))
+    return report
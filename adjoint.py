@@ -5,21 +5,22 @@ Created on Thu Nov 18 15:32:56 2021
 @author: Shelley
 """
 
-import pandas as pd
-import json
+import numpy as np
 
+from metrics import default_metrics, DEBUG
+from province_index import load_province_index
 
-adjoinpro = pd.read_json("adjoin_province.json",  encoding="utf8")
+# Compile adjoin_province.json into adjoin_province.npz, the Excel sheet is
+# kept for manual review.
+index = load_province_index("adjoin_province.json")
 
-items = []
-for i, row in adjoinpro.iterrows():
-    name, adjoins = row[['enName','adjoins']]
-    try:
-       for a in adjoins:
-           items.append([name,a.get('enName')])
-       print(name, "has %i neibours!" % len(adjoins))
-    except:
-       print(name, "has no neibours!")
+degree = np.diff(index.adjacency.indptr)
+for name, d in zip(index.names, degree):
+    if d > 0:
+        default_metrics.log("%s has %i neibours!" % (name, d), DEBUG)
+    else:
+        default_metrics.log("%s has no neibours!" % name)
 
-adjoinpro_df = pd.DataFrame(items, columns=['province','adjoint'])
+adjoinpro_df = index.to_frame().rename(columns={'Province': 'province',
+                                                'Adjoint': 'adjoint'})
 adjoinpro_df.to_excel("adjoin_province.xlsx", index=False)
\ No newline at end of file
@@ -9,11 +9,40 @@ json file.
 import json
 import os
 import sys
-import requests
-import pandas as pd
 import time
-import random
 import re
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# requests is imported by BaiduAPIConn, so convert_to_float() could be used
+# by table_io and route_cache without it.
+from metrics import default_metrics, DEBUG
+
+
+# Baidu status that worth a retry: 1 server internal error,
+# 401 concurrency exceeded.
+RETRY_STATUS = (1, 401)
+# Baidu status that the daily quota has been used up
+QUOTA_STATUS = (302,)
+# Message of a geocoding response that baidu could not find the address, it
+# comes with status 1 but is a final answer that worth saving
+NO_RESULT_MESSAGE = "无相关结果"
+# Baidu status of a driving response without a route: 7 no result,
+# 1001/1002 no route between the points, 2001 origin and destination are
+# too close. The same query would get the same answer again.
+NO_ROUTE_STATUS = (7, 1001, 1002, 2001)
+
+
+def is_final(content):
+    """
+    True if a baidu response should be saved as <id>.json: a result, a
+    geocoding no-result or a driving no-route. Other status (e.g. disabled
+    ak, illegal parameter) are not saved, so a resumed run fetches them again.
+    """
+    status = content.get("status")
+    return (status == 0 or status in NO_ROUTE_STATUS or
+            (status == 1 and NO_RESULT_MESSAGE in str(content.get("msg", ""))))
 
 
 def convert_to_float(n):
@@ -29,22 +58,121 @@ def formate_coordinate(latitude, longitude):
     return "{:.6f},{:.6f}".format(lat, lng)
 
 
+class TokenBucket(object):
+    """
+    A thread safe token bucket that caps the number of request per second.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        @Args:
+            rate: tokens that refilled per second, i.e. the QPS cap
+            capacity: max burst size, default to rate
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.timestamp) * self.rate)
+                self.timestamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class QuotaExceeded(Exception):
+    """Raised when baidu reports the daily quota is used up."""
+
+
 class BaiduAPIConn(object):
     """
     Use request package to get data from baidu geography code、
     @Attr:
         get_coordinate: get geograph code from baidu API for given address
         get_route_info: get route and save as json for 2 given points
+        batch_get_coordinate: concurrent get_coordinate for many addresses
+        batch_get_route_info: concurrent get_route_info for many connections
     """
-    def __init__(self, ak, output_path):
+    geocoding_url = "/geocoding/v3/?address=%s&output=json&ak=%s"
+    driving_url = "/direction/v2/driving?origin=%s&destination=%s&type=2&ak=%s"
+
+    def __init__(self, ak, output_path, base_url="https://api.map.baidu.com",
+                 daily_quota=None, pool_size=10, cache=None, metrics=None):
         """
         @Args:
             ak: ak that for baidu application
             Please view the following url to regist baidu api
             https://lbsyun.baidu.com/apiconsole/key#/home
+            output_path: directory that the json responses are saved to
+            base_url: baidu api host, could be replaced by a local stub server
+            daily_quota: the daily request limit of the ak, used to report
+                the remaining quota. None if unknown.
+            pool_size: number of pooled http connections
+            cache: a route_cache.RouteCache that is looked up before a route
+                request is sent, None for no cache
+            metrics: a metrics.Metrics that collects api latency, baidu
+                status and cache counters, default to metrics.default_metrics
         """
         self.ak = ak
         self.output_path = output_path
+        self.base_url = base_url.rstrip("/")
+        self.daily_quota = daily_quota
+        self.cache = cache
+        self.metrics = default_metrics if metrics is None else metrics
+        self.request_count = 0
+        self.quota_exceeded = False
+        self._count_lock = threading.Lock()
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def remaining_quota(self):
+        """Remaining daily quota of this connection, None if unknown."""
+        if self.quota_exceeded:
+            return 0
+        if self.daily_quota is None:
+            return None
+        return max(self.daily_quota - self.request_count, 0)
+
+    def _output_file(self, id):
+        return os.path.join(self.output_path, "%s.json" % str(id))
+
+    def _request(self, text):
+        """
+        Send a single request via the pooled session and decode the json.
+        Exceptions are raised to the caller.
+        """
+        with self._count_lock:
+            self.request_count += 1
+        try:
+            with self.metrics.timer("api_latency"):
+                req = self.session.get(self.base_url + text)
+            req.raise_for_status()
+            content = json.loads(req.content.decode(encoding='utf-8'))
+        except:
+            self.metrics.count("api_error")
+            raise
+        self.metrics.count("api_status_%s" % content.get("status"))
+        return content
+
+    def _save(self, id, content):
+        with open(self._output_file(id), 'w', encoding="utf-8-sig") as rf:
+            json.dump(content, rf, ensure_ascii=False)
 
     def get_coordinate(self, id, address):
         """
@@ -55,23 +183,18 @@ class BaiduAPIConn(object):
             id: Id to indentified with address
             address: chinese address
         """
-        url = "https://api.map.baidu.com/geocoding/v3/?address=%s&output=json&ak=%s"
         try:
-            req = requests.get(url % (address, self.ak))
-            addr_content = req.content.decode(encoding='utf-8')
+            address_value = self._request(self.geocoding_url % (address, self.ak))
         except:
             info = sys.exc_info()
-            print(info[0], info[1])
+            self.metrics.log("%s %s" % (info[0], info[1]))
             return None
-        address_value = json.loads(addr_content)
-        print("Save location for %s" % str(id))
-        print(address)
-        print(addr_content)
-
-        with open(os.path.join(self.output_path, "%s.json" % str(id)), 'w',
-                  encoding="utf-8-sig") as rf:
-            json.dump(address_value, rf, ensure_ascii=False)
+        self.metrics.log("Save location for %s" % str(id), DEBUG)
+        self.metrics.log(address, DEBUG)
+        self.metrics.log(address_value, DEBUG)
 
+        if is_final(address_value):
+            self._save(id, address_value)
         return address_value
 
 
@@ -85,51 +208,231 @@ class BaiduAPIConn(object):
             origin: latitude, longitude
             destination: latitude, longitude
         """
-        url = "https://api.map.baidu.com/direction/v2/driving?origin=%s&destination=%s&type=2&ak=%s"
+        if self.cache is not None:
+            route = self.cache.get(origin, destination)
+            if route is not None:
+                self.metrics.count("cache_hit")
+                self._save(id, route)
+                return route
+            self.metrics.count("cache_miss")
         try:
-            text = url % (formate_coordinate(*origin),
-                          formate_coordinate(*destination),
-                                      self.ak)
-            req = requests.get(text)
-            print(text)
-            route_content = req.content.decode(encoding='utf-8')
+            text = self.driving_url % (formate_coordinate(*origin),
+                                       formate_coordinate(*destination),
+                                       self.ak)
+            self.metrics.log(text, DEBUG)
+            route = self._request(text)
         except:
             info = sys.exc_info()
-            print(info[0], info[1])
+            self.metrics.log("%s %s" % (info[0], info[1]))
             return None
-        route = json.loads(route_content)
-        print("Save location for %s" % str(id))
-        print(route_content)
-
-        with open(os.path.join(self.output_path, "%s.json" % str(id)), 'w',
-                  encoding="utf-8-sig") as rf:
-            json.dump(route, rf, ensure_ascii=False)
+        self.metrics.log("Save location for %s" % str(id), DEBUG)
+        self.metrics.log(route, DEBUG)
 
+        if is_final(route):
+            self._save(id, route)
+            if self.cache is not None:
+                self.cache.put(origin, destination, route)
         return route
 
+    def _fetch_with_retry(self, id, text, bucket, retries, backoff,
+                          cache_key=None):
+        """
+        Fetch a single url with token bucket and exponential backoff, save
+        the response as <id>.json.
+        cache_key: (origin, destination) that the response is cached for
+        @Returns: True if the response is saved, see is_final()
+        """
+        for attempt in range(retries + 1):
+            if self.quota_exceeded:
+                raise QuotaExceeded()
+            if bucket is not None:
+                bucket.acquire()
+            try:
+                content = self._request(text)
+            except (IOError, ValueError):
+                content = None
+            status = None if content is None else content.get("status")
+            if status in QUOTA_STATUS:
+                self.quota_exceeded = True
+                self.metrics.count("quota_exceeded")
+                raise QuotaExceeded()
+            if content is not None and is_final(content):
+                self._save(id, content)
+                if cache_key is not None:
+                    self.cache.put(*cache_key, content)
+                return True
+            if content is not None and status not in RETRY_STATUS:
+                # Not worth a retry, e.g. a disabled ak
+                return False
+            if attempt < retries:
+                self.metrics.count("api_retry")
+                time.sleep(backoff * 2 ** attempt)
+        return False
+
+    def batch_fetch(self, requests_text, max_workers=8, qps=None, retries=3,
+                    backoff=0.5, overwrite=False, cache_keys=None):
+        """
+        Fetch many urls concurrently with the pooled session.
+        IDs whose output json already exists are skipped so an interrupted
+        run could be resumed.
+        @Args:
+            requests_text: iterable of (id, url path) pairs
+            max_workers: number of concurrent requests
+            qps: request per second cap, None for unlimited
+            retries: number of retries for a failed request
+            backoff: initial seconds to wait between retries, doubled each time
+            overwrite: fetch again even if the output json exists
+            cache_keys: dict of id to (origin, destination), the responses
+                of these ids are saved to the route cache
+        @Returns:
+            a report dict with following keys:
+                requested, skipped, succeeded, failed: number of ids
+                failed_ids: list of ids that could not be fetched
+                elapsed: seconds, throughput: succeeded ids per second
+                remaining_quota: remaining daily quota, None if unknown
+        """
+        todo = []
+        skipped = 0
+        for id, text in requests_text:
+            if not overwrite and os.path.exists(self._output_file(id)):
+                skipped += 1
+            else:
+                todo.append((id, text))
+
+        cache_keys = cache_keys or {}
+        bucket = TokenBucket(qps) if qps else None
+        succeeded = 0
+        failed_ids = []
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(self._fetch_with_retry, id, text,
+                                       bucket, retries, backoff,
+                                       cache_keys.get(id)): id
+                       for id, text in todo}
+            for future in as_completed(futures):
+                try:
+                    ok = future.result()
+                except QuotaExceeded:
+                    ok = False
+                if ok:
+                    succeeded += 1
+                else:
+                    failed_ids.append(futures[future])
+                self.metrics.count("fetch_succeeded" if ok else "fetch_failed")
+        elapsed = time.monotonic() - start
+        self.metrics.log("%i fetched, %i failed, %i skipped in %.1fs" % (
+            succeeded, len(failed_ids), skipped, elapsed))
+
+        return {"requested": len(todo) + skipped,
+                "skipped": skipped,
+                "succeeded": succeeded,
+                "failed": len(failed_ids),
+                "failed_ids": failed_ids,
+                "elapsed": elapsed,
+                "throughput": succeeded / elapsed if elapsed > 0 else 0.0,
+                "remaining_quota": self.remaining_quota}
+
+    def batch_get_coordinate(self, addresses, **kwargs):
+        """
+        Concurrent get_coordinate() for many addresses.
+        @Args:
+            addresses: iterable of (id, address) pairs
+            kwargs: see batch_fetch()
+        @Returns: the report of batch_fetch()
+        """
+        return self.batch_fetch(((id, self.geocoding_url % (address, self.ak))
+                                 for id, address in addresses), **kwargs)
+
+    def batch_get_route_info(self, routes, overwrite=False, **kwargs):
+        """
+        Concurrent get_route_info() for many connections. If the connection
+        has a cache, the cached routes are saved without any request.
+        @Args:
+            routes: iterable of (id, origin, destination)
+                origin, destination: latitude, longitude
+            overwrite: fetch again even if the output json exists
+            kwargs: see batch_fetch()
+        @Returns: the report of batch_fetch(), with the number of cached
+            routes that saved an API call, and batch_duplicates, the number
+            of ids whose pair is requested once for an earlier id of the
+            batch. The duplicates are not looked up in the cache, so cache
+            misses equal the requests sent.
+        """
+        todo = []
+        cache_keys = {}
+        pending = {}
+        duplicates = []
+        cached = 0
+        for id, origin, destination in routes:
+            if self.cache is not None and (overwrite or
+                                           not os.path.exists(self._output_file(id))):
+                # Only request the first id of the same pair in this batch
+                keys = [self.cache.key(origin, destination)]
+                if self.cache.symmetric:
+                    keys.append(self.cache.key(destination, origin))
+                first = next((pending[k] for k in keys if k in pending), None)
+                if first is not None:
+                    duplicates.append((id, first))
+                    continue
+                route = self.cache.get(origin, destination)
+                if route is not None:
+                    self.metrics.count("cache_hit")
+                    self._save(id, route)
+                    cached += 1
+                    continue
+                self.metrics.count("cache_miss")
+                pending[keys[0]] = id
+                cache_keys[id] = (origin, destination)
+            todo.append((id, self.driving_url % (formate_coordinate(*origin),
+                                                 formate_coordinate(*destination),
+                                                 self.ak)))
+        report = self.batch_fetch(todo, overwrite=overwrite,
+                                  cache_keys=cache_keys, **kwargs)
+        report["requested"] += cached + len(duplicates)
+
+        failed = set(report["failed_ids"])
+        for id, first in duplicates:
+            if first in failed:
+                report["failed"] += 1
+                report["failed_ids"].append(id)
+            else:
+                shutil.copyfile(self._output_file(first), self._output_file(id))
+        self.metrics.count("batch_duplicates", len(duplicates))
+        report["cached"] = cached
+        report["batch_duplicates"] = len(duplicates)
+        return report
+
 
 if __name__=='__main__':
+    import pandas as pd
+    from metrics import Metrics, INFO
     ak = "XEMXArUaUBbFEK1hd9ilOnNXIlIvrlK0"
+    metrics = Metrics(verbosity=INFO)
 
     # Steps 1 get geo loactions per address
-    bd_conn = BaiduAPIConn(ak, "./geocoding")
+    bd_conn = BaiduAPIConn(ak, "./geocoding", metrics=metrics)
     data = pd.read_csv("Address.csv", encoding="gbk")
 
-    for i, r in data.iterrows():
-        address = bd_conn.get_coordinate(r['ID'], r['City'] + "市" + r['Address'])
-        time.sleep(random.random())
+    # Each unique address is geocoded once and copied to all its IDs
+    from address_dedup import geocode_unique
+    report = geocode_unique(bd_conn, data['ID'], data['City'] + "市" + data['Address'],
+                            max_workers=8, qps=20)
+    print(report)
 
 
     # Step 2 generate loc to loc direcations
-    bd_conn = BaiduAPIConn(ak, "./route")
-    data = pd.read_csv("Address.csv", encoding="gbk")
-
-    bd_conn = BaiduAPIConn(ak, "./routes")
-    conn = pd.read_excel("connection_jn_type3.xlsx")
-    conn['Route_ID'] = conn.apply(lambda x: x['ID_orig'] + "-" + x['ID_dest'], axis=1)
-    for i, r in conn.iterrows():
-        distance = bd_conn.get_route_info(r['Route_ID'],
-                                          r['geocoding_orig'].split(","),
-                                          r['geocoding_dest'].split(","))
-        time.sleep(random.random())
-
+    from route_cache import RouteCache
+    bd_conn = BaiduAPIConn(ak, "./routes",
+                           cache=RouteCache("route_cache.sqlite", symmetric=True),
+                           metrics=metrics)
+    from table_io import load_connections
+    conn = load_connections("connection_jn.parquet", filters=[("Type", "=", 3)])
+    conn['Route_ID'] = conn['ID_orig'].astype(str) + "-" + conn['ID_dest'].astype(str)
+    report = bd_conn.batch_get_route_info(
+        zip(conn['Route_ID'],
+            zip(conn['lat_orig'], conn['lng_orig']),
+            zip(conn['lat_dest'], conn['lng_dest'])),
+        max_workers=8, qps=20)
+    print(report)
+    print(bd_conn.cache.stats())
+    metrics.dump("baidu_metrics.json")
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark every pipeline stage on synthetic dealer networks.
+
+Dealers are generated across the provinces in adjoin_province.json, the
+number of dealers of a province is proportional to its number of cities and
+they are scattered around synthetic city centers, so the neighbour density
+is close to the real data. Baidu API is replaced by a local stub server.
+
+Each stage is timed and its peak memory is traced with tracemalloc, the
+results are written as json so runs could be compared over time:
+    python benchmark.py --sizes 1000 10000 100000 --output bench.json
+
+Stages that are quadratic by design (the full connection tables, the dense
+connection matrix) are skipped above STAGE_LIMITS.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# Approximate coordinate of the capital of each province (lat, lng)
+PROVINCE_CENTERS = {
+    "Taiwan": (25.03, 121.56), "HongKong": (22.32, 114.17),
+    "Macau": (22.20, 113.54), "Hainan": (20.02, 110.35),
+    "Xinjiang": (43.83, 87.62), "Heilongjiang": (45.80, 126.53),
+    "Shanghai": (31.23, 121.47), "Tianjing": (39.13, 117.20),
+    "Beijing": (39.90, 116.40), "Ningxia": (38.49, 106.23),
+    "Tibet": (29.65, 91.13), "Guangxi": (22.82, 108.37),
+    "Fujian": (26.07, 119.30), "Jilin": (43.88, 125.32),
+    "Liaoning": (41.80, 123.43), "Qinghai": (36.62, 101.78),
+    "Yunnan": (25.04, 102.71), "Shandong": (36.65, 117.12),
+    "Jiangsu": (32.06, 118.80), "Shanxi": (37.87, 112.55),
+    "Guizhou": (26.65, 106.63), "Hunan": (28.23, 112.94),
+    "Zhejiang": (30.27, 120.15), "Chongqing": (29.56, 106.55),
+    "Gansu": (36.06, 103.83), "Hubei": (30.59, 114.31),
+    "Henan": (34.75, 113.63), "Jiangxi": (28.68, 115.86),
+    "Anhui": (31.86, 117.28), "Hebei": (38.04, 114.51),
+    "Sichuan": (30.66, 104.07), "Guangdong": (23.13, 113.26),
+    "InnerMongoria": (40.84, 111.75), "Shaanxi": (34.34, 108.94),
+}
+
+# Max number of dealers a stage is run for, None for no limit
+STAGE_LIMITS = {"generate_conn": 10000,
+                "direct_distance": 10000,
+                "conn_matrix": 2000,
+                "neighbours": None,
+                "cluster": None,
+                "fetch": None,
+                "solve": None}
+FETCH_SAMPLE = 500   # number of addresses geocoded via the stub server
+SOLVE_NODES = 100    # number of nodes of the CVRP instance
+
+
+def synthetic_dealers(n, province_file="adjoin_province.json", n_pdc=1, seed=0):
+    """
+    Generate a synthetic dealer network.
+    @Args:
+        n: number of dealers
+        province_file: the province json with cities and adjoins
+        n_pdc: number of PDC (Type 1)
+        seed: random seed
+    @Returns:
+        (address, adjprov)
+        address: a pandas dataframe with columns
+            [ID, Type, Province, City, Address, lat, lng]
+        adjprov: a pandas dataframe with columns [Province, Adjoint]
+    """
+    rng = np.random.default_rng(seed)
+    provinces = pd.read_json(province_file, encoding="utf8")
+    names = provinces["enName"].values
+    n_cities = np.array([len(c) if isinstance(c, list) else 1
+                         for c in provinces["citys"]])
+    weight = n_cities / n_cities.sum()
+    counts = rng.multinomial(n, weight)
+
+    rows = []
+    for name, cities, count in zip(names, n_cities, counts):
+        lat0, lng0 = PROVINCE_CENTERS.get(name, (30.0, 110.0))
+        spread = 0.3 * np.sqrt(cities)
+        city_lat = lat0 + rng.normal(0, spread, cities)
+        city_lng = lng0 + rng.normal(0, spread, cities)
+        city = rng.integers(0, cities, count)
+        # Dealers are around the city center, ~5 km
+        lat = city_lat[city] + rng.normal(0, 0.05, count)
+        lng = city_lng[city] + rng.normal(0, 0.05, count)
+        for c, a, b in zip(city, lat, lng):
+            rows.append((name, "%s%i" % (name, c), a, b))
+
+    address = pd.DataFrame(rows, columns=["Province", "City", "lat", "lng"])
+    address.insert(0, "ID", ["C%07d" % i for i in range(len(address))])
+    address.insert(1, "Type", 2)
+    address["Address"] = ["Road %i" % i for i in range(len(address))]
+    pdc = rng.choice(len(address), size=min(n_pdc, len(address)), replace=False)
+    address.loc[pdc, "Type"] = 1
+
+    adjprov = []
+    for name, adjoins in zip(names, provinces["adjoins"]):
+        for a in adjoins if isinstance(adjoins, list) else []:
+            adjprov.append((name, a.get("enName")))
+    adjprov = pd.DataFrame(adjprov, columns=["Province", "Adjoint"])
+    return address, adjprov
+
+
+class StubBaiduServer(object):
+    """
+    A local http server that answers baidu geocoding and driving requests
+    with synthetic results, used as base_url of BaiduAPIConn.
+        with StubBaiduServer(locations) as base_url:
+            BaiduAPIConn(ak, path, base_url=base_url)
+    """
+    def __init__(self, locations=None, detour=1.3, speed=15.0):
+        """
+        @Args:
+            locations: dict of address to (lat, lng), unknown address get a
+                random location
+            detour: driving distance / direct distance
+            speed: driving speed in meter per second
+        """
+        self.locations = locations or {}
+        self.detour = detour
+        self.speed = speed
+        self.server = None
+
+    def _handler(self):
+        stub = self
+        rng = np.random.default_rng(0)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith("/geocoding"):
+                    lat, lng = stub.locations.get(
+                        query.get("address", [""])[0],
+                        (30 + rng.random() * 10, 105 + rng.random() * 15))
+                    body = {"status": 0,
+                            "result": {"location": {"lat": lat, "lng": lng}}}
+                else:
+                    from generate_connection_table import haversine_distance
+                    o = [float(v) for v in query["origin"][0].split(",")]
+                    d = [float(v) for v in query["destination"][0].split(",")]
+                    distance = int(haversine_distance(*o, *d) * 1000 * stub.detour)
+                    body = {"status": 0,
+                            "result": {"routes": [{"distance": distance,
+                                                   "duration": int(distance / stub.speed)}]}}
+                content = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+        return Handler
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:%i" % self.server.server_port
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def measure(stage, n, func, *args, **kwargs):
+    """
+    Run a stage, measure elapsed seconds and peak traced memory.
+    @Returns: (result dict, return value of func)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        value = func(*args, **kwargs)
+        status = "ok"
+    except Exception as e:
+        value = None
+        status = "error: %s" % e
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rows = len(value) if hasattr(value, "__len__") else None
+    return {"stage": stage, "n": n, "seconds": elapsed,
+            "peak_mb": peak / 2 ** 20, "rows": rows, "status": status}, value
+
+
+def _skipped(stage, n):
+    return {"stage": stage, "n": n, "seconds": None, "peak_mb": None,
+            "rows": None, "status": "skipped"}
+
+
+def _allowed(stage, n):
+    limit = STAGE_LIMITS.get(stage)
+    return limit is None or n <= limit
+
+
+def run_size(n, workdir, seed=0):
+    """
+    Run all stages on a synthetic network of n dealers.
+    @Returns: list of stage result dict
+    """
+    import generate_connection_table as gct
+    from geocode_store import from_arrays
+
+    results = []
+    address, adjprov = synthetic_dealers(n, seed=seed)
+    store = from_arrays(os.path.join(workdir, "geocoding_%i.npy" % n),
+                        address["ID"], address["lat"], address["lng"])
+
+    def generate_conn():
+        return pd.concat([gct.generate_1_conn(address),
+                          gct.generate_2_conn(address, groupby=["Province"]),
+                          gct.generate_3_conn(address, adjprov)], axis=0)
+
+    connections = None
+    if _allowed("generate_conn", n):
+        result, connections = measure("generate_conn", n, generate_conn)
+        results.append(result)
+    else:
+        results.append(_skipped("generate_conn", n))
+
+    if connections is not None and _allowed("direct_distance", n):
+        result, _ = measure("direct_distance", n,
+                            gct.calculate_direct_distance, connections, store)
+        results.append(result)
+    else:
+        results.append(_skipped("direct_distance", n))
+
+    result, neighbours = measure("neighbours", n, gct.find_neighbours,
+                                 address, store, 2)
+    results.append(result)
+
+    if neighbours is not None and _allowed("conn_matrix", n):
+        result, _ = measure("conn_matrix", n,
+                            lambda: gct.get_cluster_id(gct.conn_matrix(neighbours)))
+        results.append(result)
+    else:
+        results.append(_skipped("conn_matrix", n))
+
+    if neighbours is not None:
+        result, _ = measure("cluster", n,
+                            lambda: gct.get_cluster_id(gct.sparse_conn_matrix(neighbours)))
+        results.append(result)
+
+    results.append(_fetch_stage(address, workdir, n))
+    results.append(_solve_stage(address, n, seed))
+    return results
+
+
+def _fetch_stage(address, workdir, n):
+    from baidumapAPI import BaiduAPIConn
+
+    sample = address.head(FETCH_SAMPLE)
+    locations = {a: (la, ln) for a, la, ln in
+                 zip(sample["City"] + "市" + sample["Address"],
+                     sample["lat"], sample["lng"])}
+    output = os.path.join(workdir, "geocoding_%i" % n)
+    os.makedirs(output, exist_ok=True)
+    with StubBaiduServer(locations) as base_url:
+        conn = BaiduAPIConn("benchmark", output, base_url=base_url)
+        result, report = measure("fetch", len(sample), conn.batch_get_coordinate,
+                                 zip(sample["ID"], locations), max_workers=8)
+    if report is not None:
+        result["throughput"] = report["throughput"]
+    return result
+
+
+def _solve_stage(address, n, seed):
+    try:
+        from cvrp_example import create_data_model
+        from cvrp_solver import solve
+    except ImportError:
+        return _skipped("solve", n)
+    from generate_connection_table import haversine_distance
+
+    rng = np.random.default_rng(seed)
+    nodes = address.iloc[:min(SOLVE_NODES, len(address))]
+    lat, lng = nodes["lat"].values, nodes["lng"].values
+    distance = haversine_distance(lat[:, None], lng[:, None],
+                                  lat[None, :], lng[None, :]) * 1000
+    demands = np.concatenate([[0], rng.integers(1, 5, len(nodes) - 1)])
+    capacity = 40
+    vehicles = int(demands.sum() // capacity) + 2
+    data = create_data_model(distance, demands, [capacity] * vehicles)
+    result, solution = measure("solve", len(nodes), solve, data, time_limit=1)
+    if solution is not None:
+        result["objective"] = solution["objective"]
+    return result
+
+
+def run(sizes, output=None, seed=0):
+    """
+    Run the benchmark for all sizes and write the results as json.
+    @Returns: the result dict
+    """
+    workdir = tempfile.mkdtemp(prefix="vrp_benchmark_")
+    try:
+        results = []
+        for n in sizes:
+            results.extend(run_size(n, workdir, seed))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": sys.version.split()[0],
+              "platform": platform.platform(),
+              "numpy": np.__version__,
+              "pandas": pd.__version__,
+              "sizes": list(sizes),
+              "results": results}
+    if output is not None:
+        with open(output, "w", encoding="utf-8") as wf:
+            json.dump(report, wf, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.output, args.seed)
+    for r in report["results"]:
+        print("%-16s n=%-7i %s" % (r["stage"], r["n"],
+              r["status"] if r["seconds"] is None
+              else "%.3fs %.1fMB %s" % (r["seconds"], r["peak_mb"], r["status"])))
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Cluster-decomposed CVRP solving.
+
+OR-tools scales badly past a few hundred nodes, so instead of one monolithic
+instance:
+1) Dealers in the same cluster (generate_connection_table.get_cluster_id())
+   are collapsed into a super node with aggregated demand, the first node of
+   the cluster is its representative.
+2) The super nodes are partitioned, by given group (e.g. province) or by
+   sweep angle around the depot.
+3) The sub problems are solved in parallel with cvrp_solver.solve(), each
+   gets a share of the fleet according to its demand.
+4) The clusters are expanded back into routes and a final inter-route
+   improvement pass is run on the full problem from the stitched routes.
+"""
+
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from cvrp_example import create_data_model
+from cvrp_solver import solve, solve_from_routes, routes_to_lists, ROUTE_DTYPE
+
+
+def collapse_clusters(data, clusters):
+    """
+    Collapse the nodes of each cluster into a super node.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        clusters: cluster label of each node, the depot should have a label
+            of its own
+    @Returns:
+        (members, demands)
+        members: list of node index array of each super node, the first
+            member is the representative
+        demands: int64 numpy array of aggregated demand of each super node
+    """
+    clusters = np.asarray(clusters)
+    _, first, codes = np.unique(clusters, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    members = [np.flatnonzero(codes == c) for c in order]
+    demands = np.array([data['demands'][m].sum() for m in members],
+                       dtype=np.int64)
+    return members, demands
+
+
+def sweep_partition(lat, lng, depot, demands, n_parts):
+    """
+    Partition nodes into n_parts sectors around the depot, with similar
+    total demand in each sector.
+    @Args:
+        lat, lng: latitude, longitude of each node
+        depot: index of depot node
+        demands: demand of each node
+        n_parts: number of sectors
+    @Returns: int numpy array of sector of each node, -1 for the depot
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    angle = np.arctan2(lat - lat[depot], lng - lng[depot])
+    order = np.argsort(angle, kind='stable')
+    order = order[order != depot]
+    demands = np.asarray(demands, dtype=np.float64)[order]
+    cumulative = np.cumsum(demands) - demands / 2
+    total = demands.sum() or 1.0
+    parts = np.full(len(lat), -1)
+    parts[order] = np.minimum((cumulative / total * n_parts).astype(int),
+                              n_parts - 1)
+    return parts
+
+
+def _allocate_vehicles(part_demands, capacities, slack=1.1):
+    """
+    Split the fleet between parts, the largest vehicles go to the part with
+    the largest remaining demand first.
+    @Returns: list of vehicle index array of each part
+    """
+    order = np.argsort(-np.asarray(capacities), kind='stable')
+    remaining = np.asarray(part_demands, dtype=np.float64) * slack
+    vehicles = [[] for _ in part_demands]
+    for v in order:
+        p = int(np.argmax(remaining))
+        vehicles[p].append(v)
+        remaining[p] -= capacities[v]
+    return [np.array(sorted(v), dtype=int) for v in vehicles]
+
+
+def stitched_result(data, routes):
+    """
+    Evaluate routes without the solver, in the same format as
+    cvrp_solver.solve().
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        routes: list of node list for each vehicle, without depot
+    @Returns:
+        a dict with objective (total distance) and routes of ROUTE_DTYPE
+    """
+    depot = int(data['depot'])
+    distance = data['distance_matrix']
+    demands = data['demands']
+    timed = 'time_matrix' in data
+    rows = []
+    objective = 0
+    for vehicle_id, route in enumerate(routes):
+        load, travelled = 0, 0
+        arrival = int(data['time_windows'][depot][0]) if timed else -1
+        path = [depot] + list(route) + [depot]
+        for sequence, node in enumerate(path):
+            if sequence > 0:
+                previous = path[sequence - 1]
+                travelled += int(distance[previous, node])
+                if timed:
+                    arrival = max(arrival + int(data['time_matrix'][previous, node]),
+                                  int(data['time_windows'][node][0]))
+            load += int(demands[node])
+            rows.append((vehicle_id, sequence, node, load, travelled, arrival))
+        objective += travelled
+    return {'objective': objective,
+            'routes': np.array(rows, dtype=ROUTE_DTYPE)}
+
+
+def _super_windows(data, members, supers):
+    """
+    Time data of super nodes for create_data_model(). The time window of a
+    super node is the intersection of the windows of its members, and its
+    service time is the sum of theirs. If the windows of the members do not
+    overlap, the window is closed at its start, the final pass on the full
+    problem handles the members one by one.
+    @Returns: dict of duration, time_windows, service_times and horizon
+    """
+    service = data['service_times']
+    windows = data['time_windows']
+    reps = np.array([members[s][0] for s in supers])
+    earliest = np.array([windows[members[s], 0].max() for s in supers])
+    latest = np.array([windows[members[s], 1].min() for s in supers])
+    # time_matrix has the service time of the starting node added
+    duration = (data['time_matrix'][np.ix_(reps, reps)]
+                - service[reps][:, None])
+    return {'duration': duration,
+            'time_windows': np.stack([earliest, np.maximum(latest, earliest)],
+                                     axis=1),
+            'service_times': np.array([service[members[s]].sum() for s in supers]),
+            'horizon': data['horizon']}
+
+
+def _solve_part(data, time_limit, config):
+    return solve(data, time_limit=time_limit, **config)
+
+
+def decompose_solve(data, clusters=None, groups=None, lat=None, lng=None,
+                    n_parts=None, time_limit=10, improve_time=None,
+                    processes=None, config=None):
+    """
+    Solve the CVRP problem by cluster decomposition.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        clusters: cluster label of each node, None for no collapsing.
+            The demand of a cluster should fit in a single vehicle.
+        groups: partition label of each node (e.g. province code), the
+            partition is done on the representative of each cluster
+        lat, lng: coordinate of each node, used for sweep partition if
+            groups is None
+        n_parts: number of sweep sectors, default to number of processes
+        time_limit: seconds for solving the sub problems
+        improve_time: seconds for the final improvement pass, default to
+            time_limit / 2, 0 to skip and return the stitched routes. The
+            stitched routes are also returned if the improvement pass could
+            not read them or finds no solution.
+        processes: number of worker processes
+        config: other search_parameters() kwargs of the sub problems
+    @Returns:
+        a dict with objective and routes in the same format as
+        cvrp_solver.solve(), and the number of parts. None if any sub
+        problem could not be solved.
+    """
+    n = len(data['distance_matrix'])
+    depot = int(data['depot'])
+    config = config or {}
+    clusters = np.arange(n) if clusters is None else np.asarray(clusters)
+    members, demands = collapse_clusters(data, clusters)
+    reps = np.array([m[0] for m in members])
+    depot_node = int(np.flatnonzero(reps == depot)[0]) if depot in reps else None
+    if depot_node is None or len(members[depot_node]) > 1:
+        raise ValueError("The depot should have a cluster of its own")
+
+    if groups is not None:
+        _, parts = np.unique(np.asarray(groups)[reps], return_inverse=True)
+    else:
+        if lat is None or lng is None:
+            raise ValueError("Either groups or lat, lng should be given")
+        n_parts = n_parts or processes or 4
+        parts = sweep_partition(np.asarray(lat)[reps], np.asarray(lng)[reps],
+                                depot_node, demands, n_parts)
+    parts[depot_node] = -1
+    part_ids = [p for p in np.unique(parts) if p >= 0]
+
+    part_nodes = [np.flatnonzero(parts == p) for p in part_ids]
+    vehicles = _allocate_vehicles([demands[s].sum() for s in part_nodes],
+                                  data['vehicle_capacities'])
+    if any(len(v) == 0 for v in vehicles):
+        raise ValueError("Not enough vehicles for %i parts" % len(part_ids))
+    sub_problems = []
+    for supers, v in zip(part_nodes, vehicles):
+        nodes = reps[np.concatenate([[depot_node], supers])]
+        windows = {}
+        if 'time_matrix' in data:
+            windows = _super_windows(data, members,
+                                     np.concatenate([[depot_node], supers]))
+        sub_problems.append(create_data_model(
+            data['distance_matrix'][np.ix_(nodes, nodes)],
+            np.concatenate([[0], demands[supers]]),
+            data['vehicle_capacities'][v], **windows))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(_solve_part, sub_problems,
+                                    [time_limit] * len(sub_problems),
+                                    [config] * len(sub_problems)))
+    if any(r is None for r in results):
+        return None
+
+    # Expand the super nodes back to the member nodes
+    routes = [[] for _ in range(int(data['num_vehicles']))]
+    for supers, v, sub, result in zip(part_nodes, vehicles, sub_problems, results):
+        for local_vehicle, stops in enumerate(
+                routes_to_lists(result['routes'], sub['num_vehicles'])):
+            for stop in stops:
+                routes[v[local_vehicle]].extend(members[supers[stop - 1]].tolist())
+
+    if improve_time is None:
+        improve_time = time_limit / 2
+    result = None
+    if improve_time > 0:
+        result = solve_from_routes(data, routes, time_limit=improve_time,
+                                   **config)
+    if result is None:
+        result = stitched_result(data, routes)
+    result['parts'] = len(part_ids)
+    return result
+
+
+def benchmark(data, time_limit=10, **kwargs):
+    """
+    Compare the monolithic solve and decompose_solve() on the same problem.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        time_limit: seconds of the monolithic solve, the decomposed solve
+            uses the same total budget for sub problems and improvement
+        kwargs: see decompose_solve()
+    @Returns:
+        a dict of objective and elapsed seconds of both solves
+    """
+    start = time.time()
+    mono = solve(data, time_limit=time_limit)
+    mono_elapsed = time.time() - start
+
+    start = time.time()
+    decomposed = decompose_solve(data, time_limit=time_limit * 2 / 3,
+                                 improve_time=time_limit / 3, **kwargs)
+    decomposed_elapsed = time.time() - start
+    return {'monolithic_objective': None if mono is None else mono['objective'],
+            'monolithic_elapsed': mono_elapsed,
+            'decomposed_objective': (None if decomposed is None
+                                     else decomposed['objective']),
+            'decomposed_elapsed': decomposed_elapsed}
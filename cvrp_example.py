@@ -1,17 +1,51 @@
 # -*- coding: utf-8 -*-
-from ortools.constraint_solver import routing_enums_pb2
-from ortools.constraint_solver import pywrapcp
+import numpy as np
 
 
-def create_data_model(distance, demands):
+def create_data_model(distance, demands, vehicle_capacities, depot=0,
+                      duration=None, time_windows=None, service_times=None,
+                      horizon=None):
     """Stores the data for the problem.
+    @Args:
+        distance: n x n distance matrix, a pandas dataframe or numpy array
+        demands: demand of each node, demand of depot should be 0
+        vehicle_capacities: capacity of each vehicle
+        depot: index of depot node
+        duration: n x n driving seconds, e.g. from route_matrix.load_matrix(),
+            None for a plain CVRP without time dimension
+        time_windows: n x 2 earliest and latest arrival seconds of each node,
+            the depot window bounds the start and end of the routes.
+            None for [0, horizon] everywhere
+        service_times: seconds spent at each node, None for 0
+        horizon: max seconds of a route, default to the latest time window
+            or 24 hours
+    @Returns:
+        a dict of problem data, the matrix and vectors are pre-converted to
+        int64 numpy arrays. With duration, 'time_matrix' is the driving time
+        plus the service time of the starting node, so the Time dimension is
+        a precomputed transit matrix as well.
     """
     data = {}
-    data['distance_matrix'] = distance.values
-    data['demands'] = [0, 1, 1, 2, 4, 2, 4, 8, 8, 1, 2, 1, 2, 4, 4, 8, 8]
-    data['vehicle_capacities'] = [15, 15, 15, 15]
-    data['num_vehicles'] = 4
-    data['depot'] = 0
+    data['distance_matrix'] = np.rint(np.asarray(distance)).astype(np.int64)
+    data['demands'] = np.asarray(demands, dtype=np.int64)
+    data['vehicle_capacities'] = np.asarray(vehicle_capacities, dtype=np.int64)
+    data['num_vehicles'] = len(data['vehicle_capacities'])
+    data['depot'] = depot
+    if duration is not None:
+        n = len(data['distance_matrix'])
+        service = (np.zeros(n, dtype=np.int64) if service_times is None
+                   else np.rint(np.asarray(service_times)).astype(np.int64))
+        time_matrix = np.rint(np.asarray(duration)).astype(np.int64) + service[:, None]
+        np.fill_diagonal(time_matrix, 0)
+        if horizon is None:
+            horizon = (24 * 3600 if time_windows is None
+                       else int(np.max(np.asarray(time_windows)[:, 1])))
+        if time_windows is None:
+            time_windows = np.tile([0, horizon], (n, 1))
+        data['time_matrix'] = time_matrix
+        data['service_times'] = service
+        data['time_windows'] = np.rint(np.asarray(time_windows)).astype(np.int64)
+        data['horizon'] = int(horizon)
     return data
 
 
@@ -44,49 +78,19 @@ def print_solution(data, manager, routing, solution):
     print('Total load of all routes: {}'.format(total_load))
 
 
-def demand_callback(from_index):
-    """Returns the demand of the node."""
-    # Convert from routing variable Index to demands NodeIndex.
-    from_node = manager.IndexToNode(from_index)
-    return data['demands'][from_node]
-
-
-
 if __name__ == '__main__':
     """Solve the CVRP problem."""
-    data = create_data_model()
-
-    manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']),
-                                           data['num_vehicles'], data['depot'])
-
-    routing = pywrapcp.RoutingModel(manager)
+    from cvrp_solver import solve
 
-    # Add transit callback
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    rng = np.random.default_rng(0)
+    points = rng.random((17, 2)) * 1000
+    distance = np.sqrt(((points[:, None] - points[None, :]) ** 2).sum(axis=2))
+    data = create_data_model(distance,
+                             [0, 1, 1, 2, 4, 2, 4, 8, 8, 1, 2, 1, 2, 4, 4, 8, 8],
+                             [15, 15, 15, 15])
 
-
-    # Add Capacity constraint.
-    demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
-    routing.AddDimensionWithVehicleCapacity(
-                             demand_callback_index,
-                             0,  # null capacity slack
-                             data['vehicle_capacities'],  # vehicle maximum capacities
-                             True,  # start cumul to zero
-                             'Capacity')
-
-    # Setting first solution heuristic.
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH)
-    search_parameters.time_limit.FromSeconds(1)
-
-    # Solve the problem.
-    solution = routing.SolveWithParameters(search_parameters)
+    result = solve(data, time_limit=1, return_model=True)
 
     # Print solution on console.
-    if solution:
-        print_solution(data, manager, routing, solution)
-
-
+    if result is not None:
+        print_solution(data, *result['model'])
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Warm-start and incremental re-solve of the daily CVRP plan.
+
+The demand changes slightly every day, so instead of solving from scratch
+the routes of the previous day are saved keyed by dealer ID, then mapped onto
+the new node set:
+1) dealers that are removed are dropped from the routes
+2) new dealers are inserted at the cheapest feasible position
+3) routes over capacity are repaired by moving out the nodes with the
+   largest saving and inserting them elsewhere
+The mapped routes are read by ReadAssignmentFromRoutes as the initial
+solution, see cvrp_solver.solve_from_routes().
+"""
+
+import json
+import numpy as np
+
+from cvrp_solver import solve, solve_from_routes
+
+
+def save_routes(file, routes, ids, depot=0):
+    """
+    Save routes keyed by dealer ID.
+    @Args:
+        file: json file name
+        routes: ROUTE_DTYPE array from cvrp_solver.solve()
+        ids: the dealer ID of each node
+        depot: index of depot node
+    """
+    ids = np.asarray(ids)
+    routes = np.sort(routes, order=['vehicle', 'sequence'])
+    num_vehicles = int(routes['vehicle'].max()) + 1 if len(routes) else 0
+    plan = [[str(ids[r['node']]) for r in routes[routes['vehicle'] == v]
+             if r['node'] != depot] for v in range(num_vehicles)]
+    with open(file, 'w', encoding="utf-8-sig") as rf:
+        json.dump({"routes": plan}, rf, ensure_ascii=False)
+
+
+def load_routes(file):
+    """
+    @Returns: list of dealer ID list for each vehicle
+    """
+    with open(file, 'r', encoding="utf-8-sig") as rf:
+        return json.load(rf)["routes"]
+
+
+def _insertion(distance, route, node, depot):
+    """Cheapest insertion position and cost of a node into a route."""
+    path = np.array([depot] + route + [depot])
+    cost = (distance[path[:-1], node] + distance[node, path[1:]]
+            - distance[path[:-1], path[1:]])
+    position = int(np.argmin(cost))
+    return position, cost[position]
+
+
+def _insert(data, routes, loads, node):
+    """
+    Insert a node to the cheapest feasible position of all routes.
+    @Returns: True if the node is inserted
+    """
+    distance = data['distance_matrix']
+    demand = data['demands'][node]
+    best = None
+    for v, route in enumerate(routes):
+        if loads[v] + demand > data['vehicle_capacities'][v]:
+            continue
+        position, cost = _insertion(distance, route, node, data['depot'])
+        if best is None or cost < best[2]:
+            best = (v, position, cost)
+    if best is None:
+        return False
+    routes[best[0]].insert(best[1], node)
+    loads[best[0]] += demand
+    return True
+
+
+def map_routes(data, ids, previous):
+    """
+    Map the routes of previous day onto the new node set.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        ids: the dealer ID of each node of the new data model
+        previous: list of dealer ID list for each vehicle, from load_routes()
+    @Returns:
+        (routes, unassigned)
+        routes: list of node list for each vehicle, without depot
+        unassigned: nodes that could not be inserted within capacity
+    """
+    depot = int(data['depot'])
+    num_vehicles = int(data['num_vehicles'])
+    position = {str(i): n for n, i in enumerate(ids)}
+    distance = data['distance_matrix']
+
+    # Drop removed dealers, keep the order of the rest
+    routes = [[position[i] for i in route if i in position and position[i] != depot]
+              for route in previous[:num_vehicles]]
+    routes += [[] for _ in range(num_vehicles - len(routes))]
+    seen = set(n for route in routes for n in route)
+    pending = [n for n in range(len(ids)) if n != depot and n not in seen]
+    loads = [int(data['demands'][route].sum()) if route else 0 for route in routes]
+
+    # Repair capacity violations by moving out the node with largest saving
+    for v, route in enumerate(routes):
+        while loads[v] > data['vehicle_capacities'][v] and route:
+            path = np.array([depot] + route + [depot])
+            saving = (distance[path[:-2], path[1:-1]] + distance[path[1:-1], path[2:]]
+                      - distance[path[:-2], path[2:]])
+            node = route.pop(int(np.argmax(saving)))
+            loads[v] -= data['demands'][node]
+            pending.append(node)
+
+    # Insert new and moved out dealers, largest demand first
+    unassigned = []
+    for node in sorted(pending, key=lambda n: -data['demands'][n]):
+        if not _insert(data, routes, loads, node):
+            unassigned.append(node)
+    return routes, unassigned
+
+
+def incremental_solve(data, ids, previous_file, output_file=None, **kwargs):
+    """
+    Re-solve the CVRP problem from the routes of previous day.
+    Fall back to solving from scratch if there is no previous routes, or
+    they could not be mapped to a feasible initial solution.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        ids: the dealer ID of each node
+        previous_file: json file saved by save_routes(), None for no warm start
+        output_file: json file to save the new routes for the next day
+        kwargs: see cvrp_solver.search_parameters()
+    @Returns:
+        the result of cvrp_solver.solve(), with 'warm_start' True if it is
+        solved from the previous routes
+    """
+    result = None
+    if previous_file is not None:
+        try:
+            previous = load_routes(previous_file)
+        except (OSError, ValueError, KeyError):
+            previous = None
+        if previous is not None:
+            routes, unassigned = map_routes(data, ids, previous)
+            if not unassigned:
+                result = solve_from_routes(data, routes, **kwargs)
+    warm_start = result is not None
+    if result is None:
+        result = solve(data, **kwargs)
+    if result is None:
+        return None
+
+    result['warm_start'] = warm_start
+    if output_file is not None:
+        save_routes(output_file, result['routes'], ids, data['depot'])
+    return result
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Reusable CVRP solver around cvrp_example.create_data_model().
+
+The distance matrix and demands are registered to OR-tools as precomputed
+matrix / vector via RegisterTransitMatrix and RegisterUnaryTransitVector,
+so no python callback runs in the inner loop of the search. If the data
+model has a time matrix (VRPTW), it is registered the same way as the arc
+transit of a Time dimension with the time window of each node.
+The routes are returned as a numpy structured array of ROUTE_DTYPE, one row
+per visited node in visiting order, depot at start and end of each route.
+"""
+
+import os
+import time
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+
+
+ROUTE_DTYPE = np.dtype([('vehicle', 'i4'),    # vehicle id
+                        ('sequence', 'i4'),   # position in the route
+                        ('node', 'i4'),       # node index of the data model
+                        ('load', 'i8'),       # cumulative load after the node
+                        ('distance', 'i8'),   # cumulative distance to the node
+                        ('time', 'i8')])      # arrival seconds, -1 without time windows
+
+# Configs of portfolio_solve(), each is the kwargs of search_parameters().
+# RoutingSearchParameters has no random seed, so the runs are diversified by
+# strategy, metaheuristic and the penalty factor of guided local search.
+DEFAULT_PORTFOLIO = [
+    {'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution': 'SAVINGS', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution': 'PARALLEL_CHEAPEST_INSERTION', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution': 'PATH_CHEAPEST_ARC', 'metaheuristic': 'SIMULATED_ANNEALING'},
+    {'first_solution': 'CHRISTOFIDES', 'metaheuristic': 'TABU_SEARCH'},
+    {'first_solution': 'SAVINGS', 'metaheuristic': 'GUIDED_LOCAL_SEARCH',
+     'guided_local_search_lambda': 0.3},
+    {'first_solution': 'PATH_MOST_CONSTRAINED_ARC', 'metaheuristic': 'GUIDED_LOCAL_SEARCH'},
+    {'first_solution': 'GLOBAL_CHEAPEST_ARC', 'metaheuristic': 'GENERIC_TABU_SEARCH'},
+]
+
+
+def build_model(data):
+    """
+    Create routing index manager and routing model with the distance matrix
+    as arc cost, a Capacity dimension and a Time dimension if the data has
+    a time matrix.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+    @Returns:
+        (manager, routing)
+    """
+    manager = pywrapcp.RoutingIndexManager(len(data['distance_matrix']),
+                                           int(data['num_vehicles']),
+                                           int(data['depot']))
+    routing = pywrapcp.RoutingModel(manager)
+
+    # Add transit matrix
+    transit_index = routing.RegisterTransitMatrix(
+        np.asarray(data['distance_matrix'], dtype=np.int64).tolist())
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_index)
+
+    # Add Capacity constraint.
+    demand_index = routing.RegisterUnaryTransitVector(
+        np.asarray(data['demands'], dtype=np.int64).tolist())
+    routing.AddDimensionWithVehicleCapacity(
+        demand_index,
+        0,  # null capacity slack
+        np.asarray(data['vehicle_capacities'], dtype=np.int64).tolist(),
+        True,  # start cumul to zero
+        'Capacity')
+
+    if 'time_matrix' in data:
+        add_time_dimension(data, manager, routing)
+    return manager, routing
+
+
+def add_time_dimension(data, manager, routing):
+    """
+    Add a Time dimension from the precomputed time matrix, waiting is
+    allowed up to the horizon. Each node must be reached within its time
+    window, the depot window bounds the start and end of all vehicles.
+    """
+    horizon = int(data['horizon'])
+    time_index = routing.RegisterTransitMatrix(
+        np.asarray(data['time_matrix'], dtype=np.int64).tolist())
+    routing.AddDimension(time_index,
+                         horizon,  # waiting time
+                         horizon,  # max time of a route
+                         False,  # vehicles could start later than 0
+                         'Time')
+    time_dimension = routing.GetDimensionOrDie('Time')
+    windows = np.asarray(data['time_windows'], dtype=np.int64)
+    depot = int(data['depot'])
+    for node, (earliest, latest) in enumerate(windows.tolist()):
+        if node == depot:
+            continue
+        time_dimension.CumulVar(manager.NodeToIndex(node)).SetRange(earliest, latest)
+    earliest, latest = windows[depot].tolist()
+    for vehicle_id in range(int(data['num_vehicles'])):
+        for index in (routing.Start(vehicle_id), routing.End(vehicle_id)):
+            time_dimension.CumulVar(index).SetRange(earliest, latest)
+            routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(index))
+
+
+def search_parameters(first_solution='PATH_CHEAPEST_ARC',
+                      metaheuristic='GUIDED_LOCAL_SEARCH', time_limit=1,
+                      guided_local_search_lambda=None):
+    """
+    @Args:
+        first_solution: name of routing_enums_pb2.FirstSolutionStrategy
+        metaheuristic: name of routing_enums_pb2.LocalSearchMetaheuristic
+        time_limit: search time limit in seconds
+        guided_local_search_lambda: penalty factor of guided local search,
+            None for OR-tools default
+    @Returns: routing search parameters
+    """
+    params = pywrapcp.DefaultRoutingSearchParameters()
+    params.first_solution_strategy = getattr(
+        routing_enums_pb2.FirstSolutionStrategy, first_solution)
+    params.local_search_metaheuristic = getattr(
+        routing_enums_pb2.LocalSearchMetaheuristic, metaheuristic)
+    params.time_limit.FromMilliseconds(int(time_limit * 1000))
+    if guided_local_search_lambda is not None:
+        params.guided_local_search_lambda_coefficient = guided_local_search_lambda
+    return params
+
+
+def extract_routes(data, manager, routing, solution):
+    """
+    Read the routes of a solution.
+    @Returns: numpy structured array of ROUTE_DTYPE
+    """
+    demands = data['demands']
+    time_dimension = (routing.GetDimensionOrDie('Time')
+                      if 'time_matrix' in data else None)
+    rows = []
+    for vehicle_id in range(int(data['num_vehicles'])):
+        index = routing.Start(vehicle_id)
+        sequence, load, distance = 0, 0, 0
+        while True:
+            node = manager.IndexToNode(index)
+            load += demands[node]
+            arrival = (-1 if time_dimension is None
+                       else solution.Min(time_dimension.CumulVar(index)))
+            rows.append((vehicle_id, sequence, node, load, distance, arrival))
+            if routing.IsEnd(index):
+                break
+            previous_index = index
+            index = solution.Value(routing.NextVar(index))
+            distance += routing.GetArcCostForVehicle(previous_index, index,
+                                                     vehicle_id)
+            sequence += 1
+    return np.array(rows, dtype=ROUTE_DTYPE)
+
+
+def solve(data, params=None, return_model=False, **kwargs):
+    """
+    Solve the CVRP problem.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        params: routing search parameters, default to search_parameters()
+            with kwargs
+        return_model: also return (manager, routing, solution) as
+            'model', e.g. for cvrp_example.print_solution()
+    @Returns:
+        a dict with objective and routes, None if no solution is found
+    """
+    manager, routing = build_model(data)
+    if params is None:
+        params = search_parameters(**kwargs)
+    solution = routing.SolveWithParameters(params)
+    if solution is None:
+        return None
+
+    result = {'objective': solution.ObjectiveValue(),
+              'routes': extract_routes(data, manager, routing, solution)}
+    if return_model:
+        result['model'] = (manager, routing, solution)
+    return result
+
+
+def solve_from_routes(data, routes, params=None, **kwargs):
+    """
+    Solve the CVRP problem with given routes as the initial solution.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        routes: list of node list for each vehicle, without depot
+        params: routing search parameters, default to search_parameters()
+            with kwargs
+    @Returns:
+        a dict with objective and routes, None if the routes could not be
+        read as an assignment or no solution is found
+    """
+    manager, routing = build_model(data)
+    if params is None:
+        params = search_parameters(**kwargs)
+    # The model has to be closed before the routes could be read
+    routing.CloseModelWithParameters(params)
+    indices = [[manager.NodeToIndex(int(node)) for node in route]
+               for route in routes]
+    initial = routing.ReadAssignmentFromRoutes(indices, True)
+    if initial is None:
+        return None
+    solution = routing.SolveFromAssignmentWithParameters(initial, params)
+    if solution is None:
+        return None
+    return {'objective': solution.ObjectiveValue(),
+            'routes': extract_routes(data, manager, routing, solution)}
+
+
+def routes_to_lists(routes, num_vehicles, depot=0):
+    """
+    Convert ROUTE_DTYPE routes to list of node list for each vehicle,
+    without depot, as required by solve_from_routes().
+    """
+    lists = [[] for _ in range(num_vehicles)]
+    for row in np.sort(routes, order=['vehicle', 'sequence']):
+        if row['node'] != depot:
+            lists[row['vehicle']].append(int(row['node']))
+    return lists
+
+
+def _solve_config(data, config, slot, deadline):
+    """
+    Worker of portfolio_solve(), solve with one config for the time slot
+    but not after the deadline.
+    Search parameters are not picklable, so they are built in the worker.
+    """
+    start = time.time()
+    remaining = min(slot, deadline - start)
+    if remaining <= 0:
+        return {'config': config, 'objective': None, 'routes': None,
+                'elapsed': 0.0}
+    result = solve(data, time_limit=remaining, **config)
+    return {'config': config,
+            'objective': None if result is None else result['objective'],
+            'routes': None if result is None else result['routes'],
+            'elapsed': time.time() - start}
+
+
+def portfolio_solve(data, configs=None, time_limit=10, processes=None):
+    """
+    Solve the same problem with several search configs in a process pool
+    under a shared wall-clock budget and keep the best solution.
+    @Args:
+        data: a dict from cvrp_example.create_data_model()
+        configs: list of search_parameters() kwargs, default DEFAULT_PORTFOLIO
+        time_limit: wall-clock budget in seconds for the whole portfolio.
+            If there are more configs than processes, the configs are run
+            in rounds and the budget is split evenly between the rounds.
+        processes: number of worker processes, None for cpu count
+    @Returns:
+        a dict with following keys, None if no config finds a solution:
+            objective, routes: of the best solution
+            config: the config of the best solution
+            runs: list of dict with config, objective and elapsed of each run
+    """
+    configs = DEFAULT_PORTFOLIO if configs is None else configs
+    processes = min(processes or os.cpu_count() or 1, len(configs))
+    rounds = -(-len(configs) // processes)
+    slot = time_limit / rounds
+    deadline = time.time() + time_limit
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        runs = list(executor.map(_solve_config,
+                                 [data] * len(configs),
+                                 configs,
+                                 [slot] * len(configs),
+                                 [deadline] * len(configs)))
+
+    solved = [r for r in runs if r['objective'] is not None]
+    if not solved:
+        return None
+    best = min(solved, key=lambda r: r['objective'])
+    return {'objective': best['objective'],
+            'routes': best['routes'],
+            'config': best['config'],
+            'runs': [{'config': r['config'],
+                      'objective': r['objective'],
+                      'elapsed': r['elapsed']} for r in runs]}
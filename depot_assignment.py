@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Assign dealers to PDCs (Type 1 depots) before generating connections and
+solving, for networks with several PDCs.
+
+Instead of connecting every PDC to every dealer and solving a single CVRP:
+1) The direct distance between all dealers and PDCs is calculated with the
+   vectorized haversine_distance().
+2) Each dealer is assigned to a PDC by a regret heuristic of the capacitated
+   assignment problem: dealers whose nearest and second nearest feasible PDC
+   differ the most are assigned first, each to its nearest PDC that still
+   has capacity for its demand.
+3) The type 1/2/3 connections and the CVRP instance are generated per PDC,
+   so each instance stays small and they are solved in parallel.
+"""
+
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+from generate_connection_table import (load_geocode_array, haversine_distance,
+                                       generate_1_conn, generate_2_conn,
+                                       generate_3_conn)
+
+
+def depot_distance(data, sourcepath):
+    """
+    Direct distance between all dealers and PDCs.
+    @Args:
+        data: a pandas dataframe the contains required columns: [ID, Type]
+        sourcepath: a directory that has all geography code saved as json,
+            or a geocode_store.GeocodeStore.
+    @Returns:
+        (dealers, depots, distance)
+        dealers, depots: numpy arrays of ID
+        distance: dealers x depots distance in KM, NaN if any geography code
+            is not found
+    """
+    dealers = data[data['Type']!=1]['ID'].values
+    depots = data[data['Type']==1]['ID'].values
+    _, lat, lng = load_geocode_array(np.concatenate([dealers, depots]), sourcepath)
+    n = len(dealers)
+    distance = haversine_distance(lat[:n, None], lng[:n, None],
+                                  lat[None, n:], lng[None, n:])
+    return dealers, depots, distance
+
+
+def capacitated_assignment(distance, demands=None, capacities=None):
+    """
+    Assign each row (dealer) to a column (PDC) with minimal total distance
+    under the capacity of each column, by the regret heuristic.
+    @Args:
+        distance: n x m cost matrix, NaN for unknown
+        demands: demand of each row, None for 1
+        capacities: capacity of each column, None for unlimited
+    @Returns:
+        int numpy array of column of each row, -1 if the row could not be
+        assigned (unknown distance or no capacity left)
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    n, m = distance.shape
+    demands = (np.ones(n) if demands is None
+               else np.asarray(demands, dtype=np.float64))
+    remaining = (np.full(m, np.inf) if capacities is None
+                 else np.asarray(capacities, dtype=np.float64).copy())
+    cost = np.where(np.isnan(distance), np.inf, distance)
+    assignment = np.full(n, -1, dtype=np.int64)
+    if m == 0:
+        return assignment
+
+    pending = np.flatnonzero(np.isfinite(cost).any(axis=1))
+    while len(pending):
+        feasible = np.where(remaining[None, :] >= demands[pending, None],
+                            cost[pending], np.inf)
+        best = np.argmin(feasible, axis=1)
+        first = feasible[np.arange(len(pending)), best]
+        placeable = np.isfinite(first)
+        if not placeable.any():
+            break
+        pending, best, feasible = pending[placeable], best[placeable], feasible[placeable]
+        first = first[placeable]
+        second = (np.partition(feasible, 1, axis=1)[:, 1] if m > 1
+                  else np.full(len(pending), np.inf))
+        # Largest regret first, a dealer without a second choice has an
+        # infinite regret. Ties are broken by the larger demand.
+        order = np.lexsort((-demands[pending], -(second - first)))
+
+        # Assign in regret order until a PDC could not take its dealer any
+        # more, then the regrets are recalculated for the rest.
+        done = 0
+        for k in order:
+            row, col = pending[k], best[k]
+            if remaining[col] < demands[row]:
+                break
+            assignment[row] = col
+            remaining[col] -= demands[row]
+            done += 1
+        pending = pending[np.sort(order[done:])]
+    return assignment
+
+
+def assign_depots(data, sourcepath, demands=None, capacities=None):
+    """
+    Assign each dealer to its nearest feasible PDC.
+    @Args:
+        data: a pandas dataframe the contains required columns: [ID, Type]
+        sourcepath: a directory that has all geography code saved as json,
+            or a geocode_store.GeocodeStore.
+        demands: column name of dealer demand in data, None for 1 per dealer
+        capacities: dict of PDC ID to capacity, None for unlimited
+    @Returns:
+        a pandas dataframe with columns [ID, Depot, geo_distance], Depot is
+        NaN for a dealer that could not be assigned
+    """
+    dealers, depots, distance = depot_distance(data, sourcepath)
+    if len(depots) == 0:
+        return pd.DataFrame({'ID': dealers,
+                             'Depot': np.full(len(dealers), np.nan, dtype=object),
+                             'geo_distance': np.full(len(dealers), np.nan)})
+    dealer_demands = None
+    if demands is not None:
+        dealer_demands = (data.set_index('ID').loc[dealers, demands]
+                          .fillna(0).values)
+    depot_capacities = None
+    if capacities is not None:
+        depot_capacities = [capacities.get(d, np.inf) for d in depots]
+
+    assignment = capacitated_assignment(distance, dealer_demands,
+                                        depot_capacities)
+    assigned = assignment >= 0
+    result = pd.DataFrame({'ID': dealers})
+    result['Depot'] = pd.Series(depots[assignment[assigned]],
+                                index=np.flatnonzero(assigned))
+    result['geo_distance'] = np.where(
+        assigned, distance[np.arange(len(dealers)), np.maximum(assignment, 0)],
+        np.nan)
+    return result
+
+
+def split_by_depot(data, assignment):
+    """
+    Split the address table into one table per PDC, each with the PDC and
+    its assigned dealers.
+    @Args:
+        data: the address table, see generate_1_conn()
+        assignment: a pandas dataframe from assign_depots()
+    @Yields:
+        (depot ID, address table)
+    """
+    depot_of = assignment.set_index('ID')['Depot']
+    for depot in data[data['Type']==1]['ID'].values:
+        dealers = depot_of.index[depot_of == depot]
+        yield depot, data[(data['ID'] == depot) | data['ID'].isin(dealers)]
+
+
+def generate_depot_conn(data, assignment, adjprov, groupby=("Province",)):
+    """
+    Generate type 1/2/3 connections per PDC, instead of connecting every
+    PDC to every dealer.
+    @Args:
+        data: the address table, see generate_1_conn()
+        assignment: a pandas dataframe from assign_depots()
+        adjprov: see generate_3_conn()
+        groupby: see generate_2_conn()
+    @Yields:
+        (depot ID, connections) connections has a column Depot
+    """
+    for depot, address in split_by_depot(data, assignment):
+        conn = pd.concat([generate_1_conn(address),
+                          generate_2_conn(address, groupby=list(groupby)),
+                          generate_3_conn(address, adjprov)], axis=0)
+        conn['Depot'] = depot
+        yield depot, conn
+
+
+def depot_instances(assignment, index, distance, demands, vehicles,
+                    duration=None, time_windows=None, service_times=None):
+    """
+    Build a CVRP data model per PDC from the full route matrix.
+    @Args:
+        assignment: a pandas dataframe from assign_depots()
+        index, distance: from route_matrix.load_matrix(), the matrix should
+            not have MISSING pairs, see impute_matrix
+        demands: dict of dealer ID to demand
+        vehicles: dict of PDC ID to list of vehicle capacity
+        duration, time_windows, service_times: optional VRPTW data, see
+            cvrp_example.create_data_model(), time_windows and service_times
+            are dicts of ID
+    @Returns:
+        dict of PDC ID to (node IDs, data model), the PDC is node 0
+    """
+    from cvrp_example import create_data_model
+
+    instances = {}
+    assigned = assignment.dropna(subset=['Depot'])
+    for depot, group in assigned.groupby('Depot', sort=False):
+        ids = np.concatenate([[depot], group['ID'].values])
+        nodes = index.get_indexer(ids.astype(str))
+        if (nodes < 0).any():
+            raise ValueError("%i IDs of depot %s are not in the matrix"
+                             % ((nodes < 0).sum(), depot))
+        windows = {}
+        if duration is not None:
+            windows['duration'] = np.asarray(duration)[np.ix_(nodes, nodes)]
+            if time_windows is not None:
+                windows['time_windows'] = [time_windows[i] for i in ids]
+            if service_times is not None:
+                windows['service_times'] = [service_times.get(i, 0) for i in ids]
+        instances[depot] = (ids, create_data_model(
+            np.asarray(distance)[np.ix_(nodes, nodes)],
+            [0] + [demands.get(i, 0) for i in ids[1:]],
+            vehicles[depot], **windows))
+    return instances
+
+
+def _solve_depot(data, time_limit, config):
+    from cvrp_solver import solve
+    return solve(data, time_limit=time_limit, **config)
+
+
+def solve_depots(instances, time_limit=10, processes=None, config=None):
+    """
+    Solve the per PDC instances in parallel.
+    @Args:
+        instances: from depot_instances()
+        time_limit: seconds for each instance
+        processes: number of worker processes
+        config: other cvrp_solver.search_parameters() kwargs
+    @Returns:
+        dict of PDC ID to the result of cvrp_solver.solve() with 'ids', the
+        dealer ID of each node. None if the instance has no solution.
+    """
+    depots = list(instances)
+    config = config or {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        results = list(executor.map(_solve_depot,
+                                    [instances[d][1] for d in depots],
+                                    [time_limit] * len(depots),
+                                    [config] * len(depots)))
+    for depot, result in zip(depots, results):
+        if result is not None:
+            result['ids'] = instances[depot][0]
+    return dict(zip(depots, results))
@@ -21,8 +21,12 @@ import json
 import os
 import numpy as np
 
-from scipy.sparse import csr_matrix
-from scipy.sparse.csgraph import connected_components
+from geocode_store import GeocodeStore
+# scipy, province_index and table_io (pyarrow) are imported by the functions
+# that need them, so importing this module stays light.
+
+
+EARTH_RADIUS = 6371.004 # Average radius of earth in KM
 
 
 def get_geocode_from_file(file):
@@ -47,15 +51,64 @@ def __geo_distance(p1, p2):
     Only works for Asha area since we don't try to identified northern
     hemisphere by and - before latitude
 
+    """
+    lat_1, lon_1 = p1
+    lat_2, lon_2 = p2
+    return haversine_distance(lat_1, lon_1, lat_2, lon_2)
+
+
+def haversine_distance(lat_1, lng_1, lat_2, lng_2):
+    """
+    Vectorized great circle distance between arrays of geography locations.
+    The haversine form is used instead of the spherical law of cosines, since
+    arccos returns NaN when rounding pushes the cosine of two near-identical
+    points slightly above 1.
+    @Args:
+        lat_1, lng_1: latitude, longitude of starting points in degree
+        lat_2, lng_2: latitude, longitude of ending points in degree
+        Scalars or numpy arrays of the same shape.
+    @Returns:
+        distance in KM, NaN where any of the input is NaN
     """
     rate = np.pi / 180
-    r = 6371.004 # Average radius of earth in KM
-    lat_1, lon_1 = np.array(p1) * rate
-    lat_2, lon_2  = np.array(p2) * rate
+    r = EARTH_RADIUS
+    lat_1 = np.asarray(lat_1, dtype=np.float64) * rate
+    lat_2 = np.asarray(lat_2, dtype=np.float64) * rate
+    d_lat = lat_2 - lat_1
+    d_lng = (np.asarray(lng_2, dtype=np.float64) -
+             np.asarray(lng_1, dtype=np.float64)) * rate
+
+    h = (np.sin(d_lat / 2) ** 2 +
+         np.cos(lat_1) * np.cos(lat_2) * np.sin(d_lng / 2) ** 2)
+    return 2 * r * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
 
-    c = np.sin(lat_1) * np.sin(lat_2) + np.cos(lat_1) * np.cos(lat_2) * np.cos(lon_1-lon_2)
-    return r * np.arccos(c)
 
+def load_geocode_array(ids, sourcepath):
+    """
+    Read the geography code of every unique id once and keep them in
+    contiguous latitude/longitude arrays.
+    @Args:
+        ids: array like of location id, duplicates are allowed.
+        sourcepath: a directory that has all geography code saved as json,
+            or a geocode_store.GeocodeStore.
+    @Returns:
+        (index, lat, lng)
+        index: a pandas Index of the unique ids, used to look up the position
+            of an id in lat/lng by index.get_indexer()
+        lat, lng: float64 numpy arrays, NaN if the geography code is not found
+    """
+    index = pd.Index(pd.unique(np.asarray(ids)))
+    if isinstance(sourcepath, GeocodeStore):
+        lat, lng = sourcepath.gather(index.values)
+        return index, lat, lng
+
+    lat = np.full(len(index), np.nan, dtype=np.float64)
+    lng = np.full(len(index), np.nan, dtype=np.float64)
+    for i, point_id in enumerate(index):
+        geo = get_geocode_from_file(os.path.join(sourcepath, "%s.json" % point_id))
+        if isinstance(geo, tuple):
+            lat[i], lng[i] = geo
+    return index, lat, lng
 
 
 def generate_1_conn(data):
@@ -153,13 +206,18 @@ def generate_3_conn(data, adjprov):
     @Args:
         data: a pandas dataframe the contains required columns:
                 [Type, ID, groupby]
-        adjprov: a pandas dataframe the contains required adjoint province
+        adjprov: a pandas dataframe the contains required adjoint province,
+            or a province_index.ProvinceIndex, whose pairs are generated by
+            integer array indexing instead of merge.
     @Return:
         conn: a pandas dataframe that each row stands for a connection between a
         given starting point and ending point.
         And the in all type 2 data, the 2 point are sorted as to make sure the
         ID of starting points is greater than ending point.
     """
+    if not isinstance(adjprov, pd.DataFrame):
+        return _generate_3_conn_index(data, adjprov)
+
     data = data.copy()
     adjprov = adjprov.copy()
     adjprov = adjprov[adjprov['Province']>adjprov['Adjoint']]
@@ -181,6 +239,140 @@ def generate_3_conn(data, adjprov):
     return full_conn
 
 
+def _generate_3_conn_index(data, index):
+    """
+    generate_3_conn() with a ProvinceIndex. Clients are sorted by province
+    position and every adjoint pair (u, v), u < v, is the cross product of
+    the 2 slices, the starting point is in province u.
+    """
+    clients = data[data['Type']!=1]
+    pos = index.encode(clients["Province"].values)
+    known = pos >= 0
+    order = np.argsort(pos[known], kind='stable')
+    ids = clients["ID"].values[known][order]
+    counts = np.bincount(pos[known], minlength=len(index))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+    u, v = index.pairs()
+    sizes = counts[u] * counts[v]
+    pair = np.repeat(np.arange(len(u)), sizes)
+    k = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    n_dest = counts[v][pair]
+    orig = starts[u][pair] + k // n_dest
+    dest = starts[v][pair] + k % n_dest
+
+    province_orig = index.names[u][pair]
+    return pd.DataFrame({'ID_orig': ids[orig],
+                         'Province_orig': province_orig,
+                         'ID_dest': ids[dest],
+                         'Province_dest': index.names[v][pair],
+                         'Adjoint': province_orig,
+                         'Type': 3})
+
+
+def _pair_chunks(n_left, n_right, chunksize, triangle=False):
+    """
+    Enumerate pairs of positions (i, j) in chunks of bounded size.
+    @Args:
+        n_left, n_right: number of items on both side
+        chunksize: max number of pairs per chunk
+        triangle: only pairs with i < j, n_right is ignored
+    @Yields:
+        (i, j) int numpy arrays
+    """
+    if triangle:
+        counts = np.arange(n_left - 1, -1, -1, dtype=np.int64)
+    else:
+        counts = np.full(n_left, n_right, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    total = offsets[-1]
+    for start in range(0, total, chunksize):
+        k = np.arange(start, min(start + chunksize, total), dtype=np.int64)
+        i = np.searchsorted(offsets, k, side='right') - 1
+        j = k - offsets[i] + (i + 1 if triangle else 0)
+        yield i, j
+
+
+def iter_1_conn(data, chunksize=100000):
+    """
+    Generator mode of generate_1_conn(), yield the connections in chunks of
+    at most chunksize rows instead of a full cross join.
+    @Args:
+        data: see generate_1_conn()
+        chunksize: max number of rows per chunk
+    @Yields:
+        pandas dataframe with the same columns as generate_1_conn()
+    """
+    depots = data[data['Type']==1]["ID"].values
+    clients = data[data['Type']!=1]["ID"].values
+    for i, j in _pair_chunks(len(depots), len(clients), chunksize):
+        yield pd.DataFrame({'ID_orig': depots[i],
+                            'Key': True,
+                            'ID_dest': clients[j],
+                            'Type': 1})
+
+
+def iter_2_conn(data, groupby=None, chunksize=100000):
+    """
+    Generator mode of generate_2_conn(). Only the upper triangle (ID of
+    starting point is greater than ending point) is generated, in chunks of
+    at most chunksize rows per group.
+    @Args:
+        data, groupby: see generate_2_conn()
+        chunksize: max number of rows per chunk
+    @Yields:
+        pandas dataframe with the same columns as generate_2_conn()
+    """
+    data = data.copy()
+    if "Type" not in data.columns:
+        data["Type"] = 2
+
+    if groupby is None:
+        groupby = ["groupkey"]
+        data["groupkey"] = 1
+
+    clients = data[data['Type']!=1][["ID"] + groupby]
+    for key, group in clients.groupby(groupby, sort=False):
+        # Sort descending, so that position i < j means ID i > ID j
+        ids = np.unique(group["ID"].values)[::-1]
+        key = key if isinstance(key, tuple) else (key,)
+        for i, j in _pair_chunks(len(ids), len(ids), chunksize, triangle=True):
+            chunk = pd.DataFrame({'ID_orig': ids[i]})
+            for col, value in zip(groupby, key):
+                chunk[col] = value
+            chunk['ID_dest'] = ids[j]
+            chunk['Key'] = True
+            chunk['Type'] = 2
+            yield chunk
+
+
+def iter_3_conn(data, adjprov, chunksize=100000):
+    """
+    Generator mode of generate_3_conn(), yield connections of each adjoint
+    province pair in chunks of at most chunksize rows.
+    @Args:
+        data, adjprov: see generate_3_conn()
+        chunksize: max number of rows per chunk
+    @Yields:
+        pandas dataframe with the same columns as generate_3_conn()
+    """
+    adjprov = adjprov[adjprov['Province']>adjprov['Adjoint']]
+    clients = data[data['Type']!=1][["ID", "Province"]]
+    ids = {p: g["ID"].values for p, g in clients.groupby("Province")}
+    for _, row in adjprov.iterrows():
+        orig = ids.get(row['Adjoint'], [])
+        dest = ids.get(row['Province'], [])
+        for i, j in _pair_chunks(len(orig), len(dest), chunksize):
+            chunk = pd.DataFrame({'ID_orig': orig[i],
+                                  'Province_orig': row['Adjoint'],
+                                  'ID_dest': dest[j],
+                                  'Province_dest': row['Province']})
+            for col in adjprov.columns.drop(['Province']):
+                chunk[col] = row[col]
+            chunk['Type'] = 3
+            yield chunk
+
+
 def calculate_direct_distance(data, sourcepath):
     """
     Fetch geography code from source path and calculate direct distance for all
@@ -191,7 +383,7 @@ def calculate_direct_distance(data, sourcepath):
         found in the source path.
         sourcepath: a directory that has all geography code saved as json.
             the geography code could be fetched via baidumapAPI get_coordinate()
-            method.
+            method. A geocode_store.GeocodeStore is also accepted.
     @Returns:
         a pandas data frame with 3 new columns:
             geocoding_orig: starting point (latitude, longitude)
@@ -199,23 +391,127 @@ def calculate_direct_distance(data, sourcepath):
             geo_distance: The direct distance
     """
     connections =  data.copy()
-    geocoding_orig = []
-    geocoding_dest = []
-    # Compute euclidean distance for the given connections
-    for i, row in connections.iterrows():
-        geocoding_orig.append(get_geocode_from_file(
-                os.path.join(sourcepath,"%s.json" % row['ID_orig'])))
-        geocoding_dest.append(get_geocode_from_file(
-                os.path.join(sourcepath,"%s.json" % row['ID_dest'])))
-    connections['geocoding_orig'] = geocoding_orig
-    connections['geocoding_dest'] = geocoding_dest
-    connections['geo_distance'] = connections.apply(lambda x:
-                                          __geo_distance(x["geocoding_orig"],
-                                                         x["geocoding_dest"]),
-                                                    axis=1)
+    geocodes = load_geocode_array(
+        np.concatenate([connections['ID_orig'].values,
+                        connections['ID_dest'].values]),
+        sourcepath)
+    return _attach_distance(connections, *geocodes)
+
+
+def iter_direct_distance(chunks, data, sourcepath):
+    """
+    Streaming version of calculate_direct_distance() for the connection
+    chunks yielded by iter_1_conn(), iter_2_conn() and iter_3_conn().
+    The geography code of all points is read once, so the memory only
+    depends on the number of points and the chunk size.
+
+    @Args：
+        chunks: iterable of pandas dataframe that contains ID_orig and ID_dest
+        data: a pandas dataframe the contains all points in column [ID]
+        sourcepath: see calculate_direct_distance()
+    @Yields:
+        the chunks with geocoding_orig, geocoding_dest and geo_distance
+    """
+    geocodes = load_geocode_array(data['ID'].values, sourcepath)
+    for chunk in chunks:
+        yield _attach_distance(chunk.copy(), *geocodes)
+
+
+def _attach_distance(connections, index, lat, lng):
+    """
+    Add geocoding_orig, geocoding_dest and geo_distance columns to the
+    connections with geography code arrays from load_geocode_array().
+    """
+    # Unknown id is located at -1, which points to the NaN appended at last
+    lat = np.append(lat, np.nan)
+    lng = np.append(lng, np.nan)
+    orig = index.get_indexer(connections['ID_orig'].values)
+    dest = index.get_indexer(connections['ID_dest'].values)
+
+    connections['geocoding_orig'] = _geocode_column(lat[orig], lng[orig])
+    connections['geocoding_dest'] = _geocode_column(lat[dest], lng[dest])
+    connections['geo_distance'] = haversine_distance(lat[orig], lng[orig],
+                                                     lat[dest], lng[dest])
     return connections
 
 
+def _geocode_column(lat, lng):
+    """
+    Format latitude, longitude arrays as the (latitude, longitude) column
+    returned by get_geocode_from_file(), so the output stays unchanged.
+    """
+    found = ~(np.isnan(lat) | np.isnan(lng))
+    return [(a, b) if f else "NotFound！"
+            for a, b, f in zip(lat.tolist(), lng.tolist(), found.tolist())]
+
+
+def to_unit_sphere(lat, lng):
+    """
+    Convert latitude, longitude in degree to 3D coordinates on unit sphere,
+    so that the euclidean distance is monotone with the great circle distance.
+    @Returns: a n x 3 float64 numpy array
+    """
+    rate = np.pi / 180
+    lat = np.asarray(lat, dtype=np.float64) * rate
+    lng = np.asarray(lng, dtype=np.float64) * rate
+    return np.column_stack([np.cos(lat) * np.cos(lng),
+                            np.cos(lat) * np.sin(lng),
+                            np.sin(lat)])
+
+
+def find_neighbours(data, sourcepath, threshold=2, query=None):
+    """
+    Find all pairs of points within given direct distance with a KD-tree,
+    instead of generating all type 1/2/3 connections first. It works in
+    O(n log n) and the result could be used by conn_matrix() directly.
+
+    @Args:
+        data: a pandas dataframe the contains required columns: [ID]
+        sourcepath: a directory that has all geography code saved as json,
+            or a geocode_store.GeocodeStore.
+        threshold: max direct distance in KM
+        query: collection of ID, only the pairs that involve any of them are
+            returned. None for all pairs.
+    @Returns:
+        a pandas dataframe with columns: [ID_orig, ID_dest, geo_distance]
+        ID of starting points is greater than ending point.
+        Points without geography code are ignored.
+    """
+    from scipy.spatial import cKDTree
+
+    index, lat, lng = load_geocode_array(data['ID'].values, sourcepath)
+    found = ~(np.isnan(lat) | np.isnan(lng))
+    index, lat, lng = index[found], lat[found], lng[found]
+
+    chord = 2 * np.sin(min(threshold / (2 * EARTH_RADIUS), np.pi / 2))
+    points = to_unit_sphere(lat, lng)
+    tree = cKDTree(points)
+    # Slightly enlarge the radius for float error, exact filter is done below
+    if query is None:
+        pairs = tree.query_pairs(chord * (1 + 1e-9), output_type='ndarray')
+        first, second = pairs[:, 0], pairs[:, 1]
+    else:
+        position = np.flatnonzero(index.isin(list(query)))
+        hits = tree.query_ball_point(points[position], chord * (1 + 1e-9))
+        first = np.repeat(position, [len(h) for h in hits])
+        second = np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]
+                                + [np.array([], dtype=np.int64)])
+
+    ids = index.values
+    swap = ids[first] < ids[second]
+    orig = np.where(swap, second, first)
+    dest = np.where(swap, first, second)
+    neighbours = pd.DataFrame({'ID_orig': ids[orig],
+                               'ID_dest': ids[dest],
+                               'geo_distance': haversine_distance(lat[orig], lng[orig],
+                                                                  lat[dest], lng[dest])})
+    neighbours = neighbours[(neighbours['geo_distance'] <= threshold) &
+                            (neighbours['ID_orig'] != neighbours['ID_dest'])]
+    # A pair of 2 queried points is found from both sides
+    neighbours = neighbours.drop_duplicates(['ID_orig', 'ID_dest'])
+    return neighbours.sort_values(['ID_orig', 'ID_dest']).reset_index(drop=True)
+
+
 def conn_matrix(data):
     """
     generate a connection matrix and with given data.
@@ -239,22 +535,60 @@ def conn_matrix(data):
     return matrix
 
 
+def sparse_conn_matrix(data):
+    """
+    generate a sparse connection matrix with given data, without the dense
+    pivot table of conn_matrix(). The ID is mapped to integer code once and
+    the memory is proportional to the number of connections.
+    @Args:
+        a pandas dataframe that bears connections.
+        Mandatory columns: ID_orig ID_dest
+    @Retruns:
+        (index, matrix)
+        index: a pandas Index of sorted vertix id
+        matrix: a symmetric scipy.sparse.csr_matrix
+    """
+    from scipy.sparse import coo_matrix
+
+    codes, index = pd.factorize(np.concatenate([data['ID_orig'].values,
+                                                data['ID_dest'].values]),
+                                sort=True)
+    n_edges = len(data)
+    orig, dest = codes[:n_edges], codes[n_edges:]
+    n = len(index)
+    # Mirror the one-way connections, duplicated entries are summed up but
+    # only the non-zero pattern matters.
+    matrix = coo_matrix((np.ones(2 * n_edges, dtype=np.int8),
+                         (np.concatenate([orig, dest]),
+                          np.concatenate([dest, orig]))),
+                        shape=(n, n)).tocsr()
+    return pd.Index(index), matrix
+
+
 def get_cluster_id(data):
     """
     Split the connection matrix to subgraph and use the lowerset id in the
     subgrap as group id
     @Args:
         a connection matrix that generated by conn_matrix() method.
-        usually it has location id as index and column name
+        usually it has location id as index and column name.
+        Or the (index, matrix) tuple that generated by sparse_conn_matrix().
     @Returns:
         a new pandas dataframe with following columns:
+            ID, Cluster_Lablel, IDCluster
 
     """
-    graph = csr_matrix(data.values)
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    if isinstance(data, tuple):
+        index, graph = data
+    else:
+        index, graph = data.index, csr_matrix(data.values)
     n_components, labels = connected_components(csgraph=graph,
                                                 directed=False,
                                                 return_labels=True)
-    cluster = pd.DataFrame(nb_matrix.index.values, columns=['ID'])
+    cluster = pd.DataFrame(index.values, columns=['ID'])
     cluster['Cluster_Lablel'] = labels
     cluster_name = cluster.groupby('Cluster_Lablel').agg({"ID":"min"}).reset_index()
     cluster = pd.merge(cluster,
@@ -266,34 +600,53 @@ def get_cluster_id(data):
 
 
 if __name__=='__main__':
+    from metrics import Metrics
+    from province_index import load_province_index
+    from table_io import save_connections
+    metrics = Metrics()
     json_path = "./geocoding"
     address = pd.read_csv("Address.csv",encoding="gbk")
     address = pd.read_csv("JN_Address.csv")
 
-    adjprovince = pd.read_excel("adjoin_province.xlsx")
+    adjprovince = load_province_index("adjoin_province.json")
     address['Type'] = (address['Type']!="PDC") + 1
-
-
-    #Generate pdc to all dealers
-    conn1 = generate_1_conn(address)
-
-    #Generate dealers to dealers in given one province
-    conn2 = generate_2_conn(address, groupby=["Province"])
-
-    # Generate Address to adjoint province
-    conn3 = generate_3_conn(address, adjprovince)
-
-    connections = pd.concat([conn1, conn2, conn3], axis=0)
-    distances = calculate_direct_distance(connections, json_path)
-    distances['geo_distance'].hist(bins=50)
-    distances[distances['geo_distance']<=10].hist()
+    # Only to look at the histogram of all direct distances again, the
+    # clustering below does not need the full connection table
+    explore = False
+
+    if explore:
+        #Generate pdc to all dealers
+        with metrics.stage("generate_1_conn") as stage:
+            conn1 = generate_1_conn(address)
+            stage["rows"] = len(conn1)
+
+        #Generate dealers to dealers in given one province
+        with metrics.stage("generate_2_conn") as stage:
+            conn2 = generate_2_conn(address, groupby=["Province"])
+            stage["rows"] = len(conn2)
+
+        # Generate Address to adjoint province
+        with metrics.stage("generate_3_conn") as stage:
+            conn3 = generate_3_conn(address, adjprovince)
+            stage["rows"] = len(conn3)
+
+        connections = pd.concat([conn1, conn2, conn3], axis=0)
+        with metrics.stage("direct_distance") as stage:
+            distances = calculate_direct_distance(connections, json_path)
+            stage["rows"] = len(distances)
+        distances['geo_distance'].hist(bins=50)
+        distances[distances['geo_distance']<=10].hist()
 
     # We set the boundary of clustering neibours to 2km from the 1 histgram.
     # which mean all dealers that within 2 km are always deiver together
     # The boundary could also be adjusted
-    neibours = distances[distances['geo_distance']<=2]
-    nb_matrix = conn_matrix(neibours)
-    cluster = get_cluster_id(nb_matrix)
+    with metrics.stage("find_neighbours") as stage:
+        neibours = find_neighbours(address, json_path, threshold=2)
+        stage["rows"] = len(neibours)
+    with metrics.stage("cluster") as stage:
+        nb_matrix = sparse_conn_matrix(neibours)
+        cluster = get_cluster_id(nb_matrix)
+        stage["rows"] = len(cluster)
     cluster.to_excel("dealer_cluster.xlsx", index=False)
 
     # Create a new address that merge some neibours toghter so as to reduce the
@@ -313,4 +666,9 @@ if __name__=='__main__':
     conn3 = generate_3_conn(merged_address, adjprovince)
 
     connections_merged = pd.concat([conn1, conn2, conn3], axis=0)
-    distances_merged = calculate_direct_distance(connections_merged, json_path)
+    with metrics.stage("direct_distance_merged") as stage:
+        distances_merged = calculate_direct_distance(connections_merged, json_path)
+        stage["rows"] = len(distances_merged)
+    save_connections(distances_merged, "connection_jn.parquet",
+                     partition_cols=["Type"])
+    metrics.dump("connection_metrics.json")
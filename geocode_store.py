@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Compact the geography code json files saved by
+baidumapAPI.BaiduAPIConn.get_coordinate() into a single binary index.
+
+The index is a numpy structured array sorted by ID with the following fields:
+    id: location id
+    lat, lng: float64 latitude and longitude, NaN if not found
+    status: 0 found, 1 NotFound (baidu could not geocode the address)
+It is saved as .npy and opened via numpy.memmap, so the lookup of a single
+ID is a binary search and the gather of an ID array is a vectorized
+searchsorted, neither of them touches the json files again.
+"""
+
+import json
+import os
+import time
+import numpy as np
+
+
+FOUND = 0
+NOT_FOUND = 1
+
+
+def _read_geocode(file):
+    """
+    Read a json file that return from baidu.
+    @Returns: (latitude, longitude, status)
+    """
+    try:
+        with open(file, 'r', encoding="utf-8-sig") as rf:
+            geo = json.load(rf)
+        return (float(geo.get("result").get("location").get("lat")),
+                float(geo.get("result").get("location").get("lng")),
+                FOUND)
+    except:
+        return np.nan, np.nan, NOT_FOUND
+
+
+def _index_dtype(id_length):
+    return np.dtype([('id', 'U%i' % max(id_length, 1)),
+                     ('lat', 'f8'),
+                     ('lng', 'f8'),
+                     ('status', 'i1')])
+
+
+class GeocodeStore(object):
+    """
+    A consolidated, memory mapped geography code index.
+    @Attr:
+        update: append the json files that are not in the index yet and
+            replace the ones rewritten since
+        lookup: get (latitude, longitude) for a single id
+        gather: get latitude, longitude arrays for an array of ids
+    """
+    def __init__(self, index_file):
+        """
+        @Args:
+            index_file: the .npy file that bears the index, it is created by
+            update() if not exists.
+        """
+        self.index_file = index_file
+        self._table = None
+        if os.path.exists(index_file):
+            self._open()
+
+    def _open(self):
+        self._table = np.load(self.index_file, mmap_mode='r')
+
+    def __len__(self):
+        return 0 if self._table is None else len(self._table)
+
+    @property
+    def ids(self):
+        if self._table is None:
+            return np.array([], dtype='U1')
+        return self._table['id']
+
+    def update(self, sourcepath, force=False):
+        """
+        Append the geography code json files in source path that are not in
+        the index yet, re-read the ones that are rewritten after the index,
+        then rewrite the sorted index.
+        @Args:
+            sourcepath: a directory that has all geography code saved as json.
+            force: re-read all the json files, even if the id is in the index
+        @Returns:
+            number of ids that appended to or replaced in the index
+        """
+        start = time.time()
+        files = {os.path.splitext(f)[0]: os.path.join(sourcepath, f)
+                 for f in os.listdir(sourcepath) if f.endswith(".json")}
+        known = np.array([], dtype='U1') if force else self.ids
+        new_ids = np.setdiff1d(np.array(list(files), dtype=str), known)
+        stale_ids = np.array([], dtype=str)
+        if len(known):
+            indexed = os.path.getmtime(self.index_file)
+            stale_ids = np.array([i for i in known if i in files and
+                                  os.path.getmtime(files[i]) > indexed],
+                                 dtype=str)
+        if len(new_ids) == 0 and len(stale_ids) == 0:
+            return 0
+
+        read_ids = np.concatenate([new_ids, stale_ids])
+        rows = [(i,) + _read_geocode(files[i]) for i in read_ids]
+        old = (self._table if self._table is not None and not force
+               else np.empty(0, dtype=_index_dtype(1)))
+        old = old[~np.isin(old['id'], stale_ids)]
+        id_length = max([len(i) for i in read_ids] + [old.dtype['id'].itemsize // 4])
+        table = np.empty(len(old) + len(rows), dtype=_index_dtype(id_length))
+        table[:len(old)] = old
+        table[len(old):] = rows
+        table = table[np.argsort(table['id'], kind='stable')]
+
+        # Release the memory map before overwriting the file
+        self._table = None
+        tmp_file = self.index_file + ".tmp.npy"
+        np.save(tmp_file, table)
+        os.replace(tmp_file, self.index_file)
+        # Date the index at the start, so a json rewritten while updating is
+        # re-read next time
+        os.utime(self.index_file, (start, start))
+        self._open()
+        return len(rows)
+
+    def locate(self, ids):
+        """
+        Find the position of given ids in the index.
+        @Returns: int array of positions, -1 if the id is not in the index
+        """
+        ids = np.asarray(ids).astype(str)
+        if self._table is None or len(self._table) == 0:
+            return np.full(ids.shape, -1, dtype=np.int64)
+        table_ids = self._table['id']
+        pos = np.searchsorted(table_ids, ids)
+        pos[pos >= len(table_ids)] = 0
+        return np.where(table_ids[pos] == ids, pos, -1)
+
+    def gather(self, ids):
+        """
+        Bulk look up the geography code for an array of ids.
+        @Args:
+            ids: array like of location id
+        @Returns:
+            (lat, lng): float64 numpy arrays, NaN if the id is not in the
+            index or not found by baidu
+        """
+        pos = self.locate(ids)
+        missing = pos < 0
+        if missing.all():
+            nan = np.full(pos.shape, np.nan)
+            return nan, nan.copy()
+        pos[missing] = 0
+        lat = np.where(missing, np.nan, self._table['lat'][pos])
+        lng = np.where(missing, np.nan, self._table['lng'][pos])
+        return lat, lng
+
+    def lookup(self, id):
+        """
+        Look up geography code for a single id.
+        @Returns: (latitude, longitude) or NotFound like
+            generate_connection_table.get_geocode_from_file()
+        """
+        pos = self.locate([id])[0]
+        if pos < 0 or self._table['status'][pos] != FOUND:
+            return "NotFound！"
+        return (float(self._table['lat'][pos]), float(self._table['lng'][pos]))
+
+
+def from_arrays(index_file, ids, lat, lng):
+    """
+    Write an index from geography code arrays directly, e.g. geocodes that
+    are not saved as json files.
+    @Args:
+        index_file: the .npy file of the index
+        ids: array like of location id
+        lat, lng: latitude, longitude arrays, NaN for not found
+    @Returns: the opened GeocodeStore
+    """
+    ids = np.asarray(ids).astype(str)
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    table = np.empty(len(ids), dtype=_index_dtype(max([len(i) for i in ids] + [1])))
+    table['id'] = ids
+    table['lat'] = lat
+    table['lng'] = lng
+    table['status'] = np.where(np.isnan(lat) | np.isnan(lng), NOT_FOUND, FOUND)
+    np.save(index_file, table[np.argsort(table['id'], kind='stable')])
+    return GeocodeStore(index_file)
+
+
+def compact(sourcepath, index_file, force=False):
+    """
+    Compact a geocoding directory into a single index file.
+    @Returns: the opened GeocodeStore
+    """
+    store = GeocodeStore(index_file)
+    store.update(sourcepath, force=force)
+    return store
+
+
+if __name__ == '__main__':
+    store = compact("./geocoding", "geocoding.npy")
+    print("%i locations in geocoding.npy" % len(store))
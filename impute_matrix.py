@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Fill the pairs that are not queried from baidu in the distance / duration
+matrix of route_matrix, so cvrp_example gets a complete dense matrix without
+spending the API quota on every pair.
+
+Only type 1/2/3 connections (depot to dealer, same province and adjoint
+province) are queried. For the others the road distance is estimated by the
+direct (haversine) distance multiplied by a detour factor. The detour factor
+is fitted from the queried pairs per distance band, and per province if the
+group of each point is given:
+    factor = sum(road * direct) / sum(direct ** 2)
+i.e. the least square fit of road = factor * direct. A part of the queried
+pairs is held out to report the error of the estimation.
+"""
+
+import numpy as np
+
+from generate_connection_table import haversine_distance
+from route_matrix import MISSING
+
+
+# Edges of direct distance band in KM
+DEFAULT_BANDS = (0, 5, 20, 50, 100, 300, np.inf)
+
+
+def direct_distance_matrix(lat, lng):
+    """
+    Direct distance in KM between all points.
+    @Args:
+        lat, lng: latitude, longitude numpy arrays of the matrix rows
+    @Returns: n x n float64 numpy array
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    return haversine_distance(lat[:, None], lng[:, None],
+                              lat[None, :], lng[None, :])
+
+
+def _pair_groups(groups, orig, dest):
+    """Group of each pair, -1 if the 2 points are not in the same group."""
+    if groups is None:
+        return np.full(len(orig), -1)
+    same = groups[orig] == groups[dest]
+    return np.where(same, groups[orig], -1)
+
+
+def fit_detour_factor(road, direct, band, group, n_bands, n_groups):
+    """
+    Fit detour factor per group and distance band.
+    @Args:
+        road, direct: float arrays of road and direct distance of queried pairs
+        band, group: int arrays of band and group of each pair, group -1 for
+            pairs across groups
+        n_bands, n_groups: number of bands and groups
+    @Returns:
+        a (n_groups + 1) x n_bands float64 numpy array, the last row is the
+        factor of all groups. Cells without data fall back to the band
+        factor of all groups, then to the overall factor.
+    """
+    def fit(r, d):
+        return (r * d).sum() / (d ** 2).sum() if (d > 0).any() else np.nan
+
+    overall = fit(road, direct)
+    factor = np.full((n_groups + 1, n_bands), np.nan)
+    for b in range(n_bands):
+        in_band = band == b
+        factor[n_groups, b] = fit(road[in_band], direct[in_band])
+        for g in range(n_groups):
+            selected = in_band & (group == g)
+            factor[g, b] = fit(road[selected], direct[selected])
+    factor[n_groups] = np.where(np.isnan(factor[n_groups]), overall,
+                                factor[n_groups])
+    factor[:n_groups] = np.where(np.isnan(factor[:n_groups]),
+                                 factor[n_groups], factor[:n_groups])
+    return factor
+
+
+def impute_matrix(matrix, direct, groups=None, bands=DEFAULT_BANDS,
+                  scale=1000, holdout=0.1, seed=0):
+    """
+    Fill MISSING pairs of a route matrix with direct distance times the
+    fitted detour factor.
+    @Args:
+        matrix: int n x n numpy array from route_matrix.build_matrix()
+        direct: n x n direct distance in KM from direct_distance_matrix()
+        groups: int array of group code (e.g. province) of each row, None to
+            fit per distance band only
+        bands: edges of direct distance band in KM
+        scale: unit of matrix per KM, 1000 for distance in meter. For a
+            duration matrix the factor is fitted as seconds per KM and scale
+            should be 1.
+        holdout: ratio of queried pairs that are held out to report the error
+        seed: random seed of the holdout split
+    @Returns:
+        (filled, report)
+        filled: int32 n x n numpy array without MISSING, unless the direct
+            distance is not known either
+        report: dict of number of queried / imputed pairs and the mean
+            absolute error and mean absolute percentage error on holdout
+    """
+    n = len(matrix)
+    orig, dest = np.triu_indices(n, k=1)
+    value = np.where(matrix[orig, dest] != MISSING, matrix[orig, dest],
+                     matrix[dest, orig]).astype(np.float64)
+    dist = direct[orig, dest]
+    band = np.clip(np.digitize(dist, bands) - 1, 0, len(bands) - 2)
+    groups = None if groups is None else np.asarray(groups)
+    group = _pair_groups(groups, orig, dest)
+    n_groups = 0 if groups is None else int(groups.max()) + 1
+
+    queried = (value != MISSING) & ~np.isnan(dist)
+    train = queried.copy()
+    test = np.zeros_like(queried)
+    if holdout > 0:
+        rng = np.random.default_rng(seed)
+        test = queried & (rng.random(len(queried)) < holdout)
+        train = queried & ~test
+
+    factor = fit_detour_factor(value[train] / scale, dist[train],
+                               band[train], group[train],
+                               len(bands) - 1, n_groups)
+    estimate = factor[np.where(group < 0, n_groups, group), band] * dist * scale
+
+    report = {"queried": int(queried.sum()),
+              "imputed": int((~queried & ~np.isnan(dist)).sum()),
+              "holdout": int(test.sum()),
+              "mae": np.nan, "mape": np.nan,
+              "factor": factor}
+    if test.any():
+        error = np.abs(estimate[test] - value[test])
+        report["mae"] = float(error.mean())
+        nonzero = value[test] > 0
+        report["mape"] = float((error[nonzero] / value[test][nonzero]).mean())
+
+    filled = np.array(matrix, dtype=np.int32)
+    fill = ~queried & ~np.isnan(dist)
+    values = np.rint(estimate[fill]).astype(np.int32)
+    # Pairs that are not queried are filled in both direction
+    for i, j in [(orig[fill], dest[fill]), (dest[fill], orig[fill])]:
+        filled[i, j] = values
+    # Mirror the queried pairs that only one direction is known
+    for i, j in [(orig, dest), (dest, orig)]:
+        mirror = queried & (matrix[i, j] == MISSING)
+        filled[i[mirror], j[mirror]] = value[mirror]
+    np.fill_diagonal(filled, 0)
+    return filled, report
+
+
+if __name__ == '__main__':
+    from geocode_store import GeocodeStore
+    from route_matrix import load_matrix, save_matrix
+
+    index, distance, duration = load_matrix("route_matrix", mmap_mode=None)
+    lat, lng = GeocodeStore("geocoding.npy").gather(index.values)
+    direct = direct_distance_matrix(lat, lng)
+    distance, report = impute_matrix(distance, direct)
+    print("distance: %i queried, %i imputed, MAPE %.3f" % (
+        report["queried"], report["imputed"], report["mape"]))
+    duration, report = impute_matrix(duration, direct, scale=1)
+    print("duration: %i queried, %i imputed, MAPE %.3f" % (
+        report["queried"], report["imputed"], report["mape"]))
+    save_matrix("route_matrix_full", index, distance, duration)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental rebuild of the distance table and dealer clusters.
+
+Instead of regenerating all type 1/2/3 connections whenever Address.csv
+changes, each run saves a content-hashed snapshot of the address table
+(ID, Type, Province and geography code). The next run diffs the address
+table against it and only:
+1) generates the connections that involve added or changed points, and
+   merges them into the stored distance table
+2) updates the neighbour edges of added, changed and removed points, and
+   reruns connected_components on the affected clusters only
+
+The state is saved in a directory:
+    snapshot.parquet, distances.parquet, neighbours.parquet, clusters.parquet
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+from generate_connection_table import (load_geocode_array, generate_1_conn,
+                                       calculate_direct_distance,
+                                       find_neighbours, sparse_conn_matrix,
+                                       get_cluster_id)
+from table_io import to_typed, CATEGORY_COLUMNS
+
+
+SNAPSHOT_COLUMNS = ["ID", "Type", "Province", "lat", "lng"]
+
+
+def address_snapshot(address, sourcepath):
+    """
+    Snapshot of the address table with geography code and content hash.
+    @Args:
+        address: a pandas dataframe with columns [ID, Type, Province]
+        sourcepath: a directory that has all geography code saved as json,
+            or a geocode_store.GeocodeStore.
+    @Returns:
+        a pandas dataframe with columns [ID, Type, Province, lat, lng, hash]
+    """
+    snapshot = address[["ID", "Type", "Province"]].drop_duplicates("ID").copy()
+    index, lat, lng = load_geocode_array(snapshot["ID"].values, sourcepath)
+    position = index.get_indexer(snapshot["ID"].values)
+    snapshot["lat"] = lat[position]
+    snapshot["lng"] = lng[position]
+    snapshot["hash"] = pd.util.hash_pandas_object(
+        snapshot[SNAPSHOT_COLUMNS].astype(str), index=False).values
+    return snapshot.reset_index(drop=True)
+
+
+def diff_snapshot(old, new):
+    """
+    @Returns:
+        (touched, removed)
+        touched: set of ID that are added or changed in new snapshot
+        removed: set of ID that are not in new snapshot
+    """
+    old_hash = dict(zip(old["ID"], old["hash"]))
+    touched = set(i for i, h in zip(new["ID"], new["hash"])
+                  if old_hash.get(i) != h)
+    removed = set(old["ID"]) - set(new["ID"])
+    return touched, removed
+
+
+def _oriented(pairs, columns):
+    """Make sure ID_orig > ID_dest and drop duplicated and self pairs."""
+    pairs = pairs[pairs["ID_a"] != pairs["ID_b"]]
+    swap = pairs["ID_a"] < pairs["ID_b"]
+    pairs = pairs.assign(ID_orig=np.where(swap, pairs["ID_b"], pairs["ID_a"]),
+                         ID_dest=np.where(swap, pairs["ID_a"], pairs["ID_b"]))
+    return pairs.drop_duplicates(["ID_orig", "ID_dest"])[columns]
+
+
+def touched_connections(address, adjprov, touched):
+    """
+    Generate type 1/2/3 connections that involve any of the touched points,
+    the same rows as generate_1/2/3_conn() would generate for them.
+    @Args:
+        address: a pandas dataframe with columns [ID, Type, Province]
+        adjprov: a pandas dataframe the contains required adjoint province
+        touched: set of ID
+    @Returns:
+        a pandas dataframe of connections
+    """
+    # Touched depots to all clients, the other depots to touched clients
+    depots = address[address["Type"]==1]
+    clients = address[address["Type"]!=1]
+    depot_touched = depots["ID"].isin(touched)
+    conn1 = pd.concat([
+        generate_1_conn(pd.concat([depots[depot_touched], clients])),
+        generate_1_conn(pd.concat([depots[~depot_touched],
+                                   clients[clients["ID"].isin(touched)]]))],
+        axis=0)
+
+    clients = clients[["ID", "Province"]]
+    changed = clients[clients["ID"].isin(touched)]
+    conn2 = pd.merge(changed.rename(columns={"ID": "ID_a"}),
+                     clients.rename(columns={"ID": "ID_b"}),
+                     on="Province")
+    conn2 = _oriented(conn2, ["ID_orig", "Province", "ID_dest"])
+    conn2["Key"] = True
+    conn2["Type"] = 2
+
+    adjprov = adjprov[adjprov["Province"]>adjprov["Adjoint"]]
+    orig = clients.rename(columns={"ID": "ID_orig", "Province": "Province_orig"})
+    dest = clients.rename(columns={"ID": "ID_dest", "Province": "Province_dest"})
+    conn3 = []
+    for orig_side, dest_side in [(orig[orig["ID_orig"].isin(touched)], dest),
+                                 (orig, dest[dest["ID_dest"].isin(touched)])]:
+        pairs = pd.merge(adjprov, orig_side, left_on="Adjoint",
+                         right_on="Province_orig")
+        conn3.append(pd.merge(pairs, dest_side, left_on="Province",
+                              right_on="Province_dest"))
+    conn3 = (pd.concat(conn3).drop_duplicates(["ID_orig", "ID_dest"])
+               .drop(columns="Province"))
+    conn3 = conn3[["ID_orig", "Province_orig", "ID_dest", "Province_dest",
+                   "Adjoint"]].assign(Type=3)
+
+    return pd.concat([conn1, conn2, conn3], axis=0, ignore_index=True)
+
+
+def update_clusters(clusters, neighbours, affected):
+    """
+    Rerun connected_components on the affected clusters only.
+    @Args:
+        clusters: the cluster table from get_cluster_id() of last run,
+            including the removed points, so that their clusters are rerun
+        neighbours: the updated neighbour edges, without removed points
+        affected: set of ID whose edges are changed, including removed ID
+    @Returns:
+        the updated cluster table with the same columns as get_cluster_id()
+    """
+    affected_labels = set(clusters.loc[clusters["ID"].isin(affected),
+                                       "Cluster_Lablel"])
+    keep = clusters[~clusters["Cluster_Lablel"].isin(affected_labels)]
+    nodes = (set(affected) |
+             set(clusters.loc[clusters["Cluster_Lablel"].isin(affected_labels), "ID"]))
+    edges = neighbours[neighbours["ID_orig"].isin(nodes) |
+                       neighbours["ID_dest"].isin(nodes)]
+    if len(edges) == 0:
+        return keep.reset_index(drop=True)
+
+    new = get_cluster_id(sparse_conn_matrix(edges))
+    start = clusters["Cluster_Lablel"].max() + 1 if len(clusters) else 0
+    new["Cluster_Lablel"] += start
+    # Drop kept clusters that are merged into the new components
+    keep = keep[~keep["ID"].isin(new["ID"])]
+    return pd.concat([keep, new], ignore_index=True)
+
+
+def _concat_distances(frames):
+    """
+    Concatenate distance tables in the layout of table_io.to_typed(), so the
+    reloaded and the recomputed rows share the same columns and dtypes.
+    """
+    frames = [to_typed(f) for f in frames]
+    frames = [f for f in frames if len(f)] or frames[:1]
+    columns = list(dict.fromkeys(c for f in frames for c in f.columns))
+    categories = {c: object for c in CATEGORY_COLUMNS if c in columns}
+    frames = [f.reindex(columns=columns).astype(categories) for f in frames]
+    return to_typed(pd.concat(frames, ignore_index=True))
+
+
+def _read(state_dir, name):
+    file = os.path.join(state_dir, "%s.parquet" % name)
+    return pd.read_parquet(file) if os.path.exists(file) else None
+
+
+def _write(state_dir, name, data):
+    data.to_parquet(os.path.join(state_dir, "%s.parquet" % name), index=False)
+
+
+def incremental_build(address, adjprov, sourcepath, state_dir, threshold=2):
+    """
+    Rebuild the distance table, neighbours and clusters incrementally.
+    The first run, when state_dir is empty, builds everything.
+    @Args:
+        address: a pandas dataframe with columns [ID, Type, Province]
+        adjprov: a pandas dataframe the contains required adjoint province
+        sourcepath: see calculate_direct_distance()
+        state_dir: directory that the state of last run is saved
+        threshold: max direct distance of neighbours in KM
+    @Returns:
+        (distances, clusters, report)
+        distances: the distance table of all connections, the same as
+            calculate_direct_distance() in the layout of table_io.to_typed()
+        clusters: the cluster table, the same as get_cluster_id()
+        report: dict with number of touched / removed points and the number
+            of connections that are recomputed
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    snapshot = address_snapshot(address, sourcepath)
+    old = _read(state_dir, "snapshot")
+    distances = _read(state_dir, "distances")
+    neighbours = _read(state_dir, "neighbours")
+    clusters = _read(state_dir, "clusters")
+
+    if old is None or distances is None or neighbours is None or clusters is None:
+        touched, removed = set(snapshot["ID"]), set()
+        distances = _concat_distances([calculate_direct_distance(
+            touched_connections(address, adjprov, touched), sourcepath)])
+        neighbours = find_neighbours(snapshot, sourcepath, threshold)
+        clusters = get_cluster_id(sparse_conn_matrix(neighbours))
+        recomputed = len(distances)
+    else:
+        touched, removed = diff_snapshot(old, snapshot)
+        changed = touched | removed
+        distances = distances[~(distances["ID_orig"].isin(changed) |
+                                distances["ID_dest"].isin(changed))]
+        new_distances = calculate_direct_distance(
+            touched_connections(address, adjprov, touched), sourcepath)
+        distances = _concat_distances([distances, new_distances])
+        recomputed = len(new_distances)
+
+        neighbours = neighbours[~(neighbours["ID_orig"].isin(changed) |
+                                  neighbours["ID_dest"].isin(changed))]
+        new_neighbours = find_neighbours(snapshot, sourcepath, threshold,
+                                         query=touched)
+        if len(new_neighbours):
+            neighbours = pd.concat([neighbours, new_neighbours], ignore_index=True)
+        affected = (changed | set(new_neighbours["ID_orig"]) |
+                    set(new_neighbours["ID_dest"]))
+        # The removed points stay in clusters until their labels are known
+        clusters = update_clusters(clusters, neighbours, affected)
+
+    _write(state_dir, "snapshot", snapshot)
+    _write(state_dir, "distances", distances)
+    _write(state_dir, "neighbours", neighbours)
+    _write(state_dir, "clusters", clusters)
+    return distances, clusters, {"touched": len(touched),
+                                 "removed": len(removed),
+                                 "recomputed": recomputed}
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Timers, counters and progress reporting for the pipeline.
+
+A Metrics object collects:
+    counters: e.g. number of requests per baidu status, cache hits
+    latencies: seconds of each observation of a timer, e.g. api latency,
+        summarized as count, mean and p50/p90/p99
+    stages: elapsed seconds and rows/sec of each pipeline stage
+Every record is also passed to the hooks as an event dict, so a progress
+bar or a monitoring client could subscribe:
+    metrics = Metrics(verbosity=INFO)
+    metrics.add_hook(lambda event: ...)
+    with metrics.stage("generate_2_conn") as stage:
+        stage["rows"] = len(generate_2_conn(address))
+    metrics.dump("metrics.json")
+
+Messages are printed only if their level is not above the verbosity, which
+replaces the unconditional prints of the modules.
+"""
+
+import json
+import threading
+import time
+import numpy as np
+
+from contextlib import contextmanager
+
+
+QUIET = 0
+INFO = 1
+DEBUG = 2
+
+
+class Metrics(object):
+    """
+    Thread safe collector of counters, latencies and stage timings.
+    @Attr:
+        log: print a message if level <= verbosity
+        count: increase a counter
+        observe: add an observation to a timer
+        timer: context manager that observes the elapsed seconds
+        stage: context manager that records a pipeline stage
+        add_hook: register a callback for every event
+        summary: a json serializable dict of all metrics
+        dump: write summary() as json
+    """
+    def __init__(self, verbosity=INFO):
+        """
+        @Args:
+            verbosity: QUIET, INFO or DEBUG
+        """
+        self.verbosity = verbosity
+        self.counters = {}
+        self.latencies = {}
+        self.stages = []
+        self.hooks = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """
+        @Args:
+            hook: callable that receives an event dict with key 'event'
+                ('count', 'observe', 'stage' or 'log') and its values
+        """
+        self.hooks.append(hook)
+
+    def _emit(self, **event):
+        for hook in self.hooks:
+            hook(event)
+
+    def log(self, message, level=INFO):
+        if level <= self.verbosity:
+            print(message)
+        if self.hooks:
+            self._emit(event="log", level=level, message=message)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.hooks:
+            self._emit(event="count", name=name, value=value)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+        if self.hooks:
+            self._emit(event="observe", name=name, seconds=seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Record elapsed seconds of a pipeline stage, set 'rows' of the yielded
+        dict to get rows/sec.
+        """
+        record = {"stage": name, "rows": None}
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            rows = record["rows"]
+            record["rows_per_sec"] = (rows / record["seconds"]
+                                      if rows is not None and record["seconds"] > 0
+                                      else None)
+            with self._lock:
+                self.stages.append(record)
+            self.log("%s: %.3fs%s" % (name, record["seconds"],
+                                     "" if rows is None else
+                                     ", %i rows, %.0f rows/s" % (rows, record["rows_per_sec"] or 0)))
+            if self.hooks:
+                self._emit(event="stage", **record)
+
+    def rate(self, name, total):
+        """Ratio of counter name to the sum of counters total, None if 0."""
+        return self._ratio([name], total)
+
+    def _ratio(self, names, total):
+        denominator = sum(self.counters.get(t, 0) for t in total)
+        if denominator == 0:
+            return None
+        return sum(self.counters.get(n, 0) for n in names) / denominator
+
+    def summary(self):
+        """
+        @Returns: a dict with counters, rates, latencies (count, mean, p50,
+            p90, p99 in seconds) and stages. The rates are:
+            api_error_rate: requests failed on http / json level or answered
+                with a non-zero baidu status other than quota, per request
+            transport_error_rate: requests failed on http / json level only,
+                per request
+            quota_exceeded: requests answered with a quota status per request
+            cache_hit_rate: route cache hits per lookup
+            None if there is no request or lookup.
+        """
+        with self._lock:
+            latencies = {}
+            for name, values in self.latencies.items():
+                values = np.asarray(values)
+                p50, p90, p99 = np.percentile(values, [50, 90, 99])
+                latencies[name] = {"count": len(values),
+                                   "mean": float(values.mean()),
+                                   "p50": float(p50),
+                                   "p90": float(p90),
+                                   "p99": float(p99)}
+            from baidumapAPI import QUOTA_STATUS
+
+            statuses = [c for c in self.counters if c.startswith("api_status_")]
+            requests = ["api_error"] + statuses
+            quota = ["api_status_%s" % s for s in QUOTA_STATUS]
+            errors = ["api_error"] + [c for c in statuses
+                                      if c != "api_status_0" and c not in quota]
+            rates = {"api_error_rate": self._ratio(errors, requests),
+                     "transport_error_rate": self.rate("api_error", requests),
+                     "quota_exceeded": self.rate("quota_exceeded", requests),
+                     "cache_hit_rate": self.rate("cache_hit",
+                                                 ["cache_hit", "cache_miss"])}
+            return {"counters": dict(self.counters),
+                    "rates": rates,
+                    "latencies": latencies,
+                    "stages": list(self.stages)}
+
+    def dump(self, file):
+        with open(file, "w", encoding="utf-8") as wf:
+            json.dump(self.summary(), wf, indent=2)
+
+
+# Collector used when a module is not given one
+default_metrics = Metrics()
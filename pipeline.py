@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Command line entry point of the pipeline, each stage is a subcommand:
+    python pipeline.py geocode --input Address.csv --output ./geocoding --ak <ak>
+    python pipeline.py connections --input Address.csv --output connection.parquet
+    python pipeline.py distances --input connection.parquet --geocoding geocoding.npy \\
+        --output distance.parquet
+    python pipeline.py cluster --input Address.csv --geocoding geocoding.npy \\
+        --output dealer_cluster.csv
+    python pipeline.py assign --input Address.csv --geocoding geocoding.npy \\
+        --output depot_assignment.csv --connections connection.parquet
+    python pipeline.py routes --input distance.parquet --output ./routes --ak <ak> \\
+        --matrix route_matrix
+    python pipeline.py impute --matrix route_matrix --geocoding geocoding.npy \\
+        --groups Address.csv --output route_matrix_full
+    python pipeline.py solve --matrix route_matrix_full --demands demands.csv \\
+        --capacity 15 --vehicles 4 --output routes.csv
+
+Only the standard library is imported here. numpy/pandas, scipy, pyarrow,
+requests and ortools are imported by the subcommand that needs them, so a
+command does not pay for the dependencies of the others.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+
+def _read_table(file, encoding=None):
+    """Read a csv, Excel or parquet table by the file extension."""
+    import pandas as pd
+
+    ext = os.path.splitext(file)[1].lower()
+    if ext in (".xlsx", ".xls"):
+        return pd.read_excel(file)
+    if ext == ".parquet" or os.path.isdir(file):
+        from table_io import load_connections
+        return load_connections(file)
+    return pd.read_csv(file, encoding=encoding)
+
+
+def _write_table(data, file, partition_cols=None):
+    """Write a csv, Excel or parquet table by the file extension."""
+    ext = os.path.splitext(file)[1].lower()
+    if ext in (".xlsx", ".xls"):
+        from table_io import export_excel
+        export_excel(data, file)
+    elif ext == ".csv":
+        data.to_csv(file, index=False)
+    else:
+        from table_io import save_connections
+        save_connections(data, file, partition_cols=partition_cols)
+
+
+def _geocoding(path):
+    """A GeocodeStore for a .npy index, otherwise the json directory."""
+    if path.endswith(".npy"):
+        from geocode_store import GeocodeStore
+        return GeocodeStore(path)
+    return path
+
+
+def _metrics(args):
+    from metrics import Metrics
+    return Metrics(verbosity=args.verbosity)
+
+
+def _dump_metrics(args, metrics):
+    if args.metrics is not None:
+        metrics.dump(args.metrics)
+
+
+def geocode(args):
+    from baidumapAPI import BaiduAPIConn
+
+    metrics = _metrics(args)
+    address = _read_table(args.input, args.encoding)
+    os.makedirs(args.output, exist_ok=True)
+    conn = BaiduAPIConn(args.ak, args.output, metrics=metrics)
+    text = address['City'] + "市" + address['Address']
+    if args.dedup == "none":
+        report = conn.batch_get_coordinate(zip(address['ID'], text),
+                                           max_workers=args.workers, qps=args.qps)
+    else:
+        from address_dedup import geocode_unique
+        report = geocode_unique(conn, address['ID'], text,
+                                near=args.dedup == "near",
+                                max_workers=args.workers, qps=args.qps)
+    if args.index is not None:
+        from geocode_store import compact
+        compact(args.output, args.index)
+    _dump_metrics(args, metrics)
+    return {k: v for k, v in report.items() if k != "failed_ids"}
+
+
+def connections(args):
+    import pandas as pd
+    import generate_connection_table as gct
+    from province_index import load_province_index
+
+    metrics = _metrics(args)
+    address = _read_table(args.input, args.encoding)
+    if address['Type'].dtype == object:
+        address['Type'] = (address['Type'] != "PDC") + 1
+    tables = []
+    for conn_type in args.types:
+        with metrics.stage("generate_%i_conn" % conn_type) as stage:
+            if conn_type == 1:
+                table = gct.generate_1_conn(address)
+            elif conn_type == 2:
+                table = gct.generate_2_conn(address, groupby=["Province"])
+            else:
+                table = gct.generate_3_conn(
+                    address, load_province_index(args.provinces).k_hop(args.hops))
+            stage["rows"] = len(table)
+        tables.append(table)
+    table = pd.concat(tables, axis=0)
+    _write_table(table, args.output, partition_cols=["Type"])
+    _dump_metrics(args, metrics)
+    return {"rows": len(table)}
+
+
+def distances(args):
+    from generate_connection_table import calculate_direct_distance
+
+    metrics = _metrics(args)
+    table = _read_table(args.input, args.encoding)
+    with metrics.stage("direct_distance") as stage:
+        table = calculate_direct_distance(table, _geocoding(args.geocoding))
+        stage["rows"] = len(table)
+    _write_table(table, args.output, partition_cols=["Type"])
+    _dump_metrics(args, metrics)
+    return {"rows": len(table),
+            "without_geocode": int(table['geo_distance'].isna().sum())}
+
+
+def cluster(args):
+    import generate_connection_table as gct
+
+    metrics = _metrics(args)
+    address = _read_table(args.input, args.encoding)
+    with metrics.stage("cluster") as stage:
+        neighbours = gct.find_neighbours(address, _geocoding(args.geocoding),
+                                         threshold=args.threshold)
+        clusters = gct.get_cluster_id(gct.sparse_conn_matrix(neighbours))
+        stage["rows"] = len(clusters)
+    _write_table(clusters, args.output)
+    _dump_metrics(args, metrics)
+    return {"clustered": len(clusters),
+            "clusters": int(clusters['IDCluster'].nunique())}
+
+
+def assign(args):
+    import pandas as pd
+    from depot_assignment import assign_depots, generate_depot_conn
+    from province_index import load_province_index
+
+    metrics = _metrics(args)
+    address = _read_table(args.input, args.encoding)
+    if address['Type'].dtype == object:
+        address['Type'] = (address['Type'] != "PDC") + 1
+    capacities = None
+    if args.capacities is not None:
+        table = _read_table(args.capacities, args.encoding)
+        capacities = dict(zip(table['ID'], table['Capacity']))
+    with metrics.stage("assign_depots") as stage:
+        assignment = assign_depots(address, _geocoding(args.geocoding),
+                                   demands=args.demand_column,
+                                   capacities=capacities)
+        stage["rows"] = len(assignment)
+    _write_table(assignment, args.output)
+    if args.connections is not None:
+        index = load_province_index(args.provinces)
+        with metrics.stage("generate_depot_conn") as stage:
+            table = pd.concat([conn for _, conn in
+                               generate_depot_conn(address, assignment, index)],
+                              axis=0)
+            stage["rows"] = len(table)
+        _write_table(table, args.connections, partition_cols=["Depot", "Type"])
+    _dump_metrics(args, metrics)
+    return {"dealers": len(assignment),
+            "unassigned": int(assignment['Depot'].isna().sum()),
+            "per_depot": assignment['Depot'].value_counts().to_dict()}
+
+
+def routes(args):
+    from baidumapAPI import BaiduAPIConn
+
+    metrics = _metrics(args)
+    cache = None
+    if args.cache is not None:
+        from route_cache import RouteCache
+        cache = RouteCache(args.cache, symmetric=True)
+    table = _read_table(args.input, args.encoding)
+    if args.types:
+        table = table[table['Type'].isin(args.types)]
+    os.makedirs(args.output, exist_ok=True)
+    conn = BaiduAPIConn(args.ak, args.output, cache=cache, metrics=metrics)
+    route_id = table['ID_orig'].astype(str) + "-" + table['ID_dest'].astype(str)
+    report = conn.batch_get_route_info(
+        zip(route_id,
+            zip(table['lat_orig'], table['lng_orig']),
+            zip(table['lat_dest'], table['lng_dest'])),
+        max_workers=args.workers, qps=args.qps)
+    if args.matrix is not None:
+        from route_matrix import load_routes, build_matrix, save_matrix
+        with metrics.stage("route_matrix") as stage:
+            parsed = load_routes(args.output)
+            save_matrix(args.matrix, *build_matrix(parsed))
+            stage["rows"] = len(parsed)
+    _dump_metrics(args, metrics)
+    return {k: v for k, v in report.items() if k != "failed_ids"}
+
+
+def impute(args):
+    import pandas as pd
+    from impute_matrix import direct_distance_matrix, impute_matrix
+    from geocode_store import GeocodeStore
+    from route_matrix import load_matrix, save_matrix
+
+    metrics = _metrics(args)
+    index, distance, duration = load_matrix(args.matrix, mmap_mode=None)
+    lat, lng = GeocodeStore(args.geocoding).gather(index.values)
+    groups = None
+    if args.groups is not None:
+        # Group code of each matrix row by the Province of the address table,
+        # -1 for IDs without one
+        address = _read_table(args.groups, args.encoding)
+        province = pd.Series(address['Province'].values,
+                             index=address['ID'].astype(str).values)
+        province = province[~province.index.duplicated()]
+        groups = pd.factorize(province.reindex(index.values))[0]
+    with metrics.stage("impute_matrix") as stage:
+        direct = direct_distance_matrix(lat, lng)
+        distance, distance_report = impute_matrix(distance, direct, groups,
+                                                  holdout=args.holdout)
+        duration, duration_report = impute_matrix(duration, direct, groups,
+                                                  scale=1, holdout=args.holdout)
+        stage["rows"] = len(index)
+    save_matrix(args.output, index, distance, duration)
+    _dump_metrics(args, metrics)
+    return {name: {k: report[k] for k in ("queried", "imputed", "mae", "mape")}
+            for name, report in [("distance", distance_report),
+                                 ("duration", duration_report)]}
+
+
+def solve(args):
+    import numpy as np
+    from cvrp_example import create_data_model
+    from cvrp_solver import solve as solve_cvrp
+    from route_matrix import load_matrix, MISSING
+
+    metrics = _metrics(args)
+    index, distance, duration = load_matrix(args.matrix, mmap_mode=None)
+    demands = _read_table(args.demands, args.encoding)
+    # The depot is the first row of the demand table
+    nodes = index.get_indexer(demands['ID'].astype(str).values)
+    if (nodes < 0).any():
+        raise SystemExit("%i IDs of the demand table are not in the matrix"
+                         % (nodes < 0).sum())
+    distance = distance[np.ix_(nodes, nodes)]
+    if (distance == MISSING).any():
+        raise SystemExit("The matrix has pairs that are not queried, "
+                         "fill them with the impute command first")
+
+    windows = {}
+    if args.time_windows:
+        # VRPTW with the duration matrix and [Open, Close, Service] seconds
+        # of the demand table
+        duration = duration[np.ix_(nodes, nodes)]
+        if (duration == MISSING).any():
+            raise SystemExit("The duration matrix has pairs that are not "
+                             "queried, fill them with the impute command first")
+        windows = {'duration': duration,
+                   'time_windows': demands[['Open', 'Close']].values,
+                   'service_times': (demands['Service'].values
+                                     if 'Service' in demands.columns else None)}
+    data = create_data_model(distance, demands['Demand'].values,
+                             [args.capacity] * args.vehicles, **windows)
+    with metrics.stage("solve") as stage:
+        result = solve_cvrp(data, time_limit=args.time_limit)
+        stage["rows"] = len(nodes)
+    _dump_metrics(args, metrics)
+    if result is None:
+        raise SystemExit("No solution found")
+
+    import pandas as pd
+    plan = pd.DataFrame(result['routes'])
+    plan['ID'] = demands['ID'].values[plan['node'].values]
+    _write_table(plan, args.output)
+    return {"objective": int(result['objective']),
+            "vehicles_used": int(plan.groupby('vehicle')['sequence'].max()
+                                 .gt(1).sum())}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--encoding", default=None,
+                        help="encoding of csv input, e.g. gbk")
+    common.add_argument("--verbosity", type=int, default=1,
+                        help="0 quiet, 1 info, 2 debug")
+    common.add_argument("--metrics", default=None,
+                        help="json file that the metrics are dumped to")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("geocode", parents=[common],
+                       help="geocode addresses via baidu api")
+    p.add_argument("--input", required=True, help="address table")
+    p.add_argument("--output", default="./geocoding", help="json directory")
+    p.add_argument("--index", default=None,
+                   help="compact the json into this .npy geocode index")
+    p.add_argument("--dedup", choices=["none", "exact", "near"], default="exact",
+                   help="geocode each unique address once, near also ignores "
+                        "whitespace and bracketed remarks")
+    p.add_argument("--ak", required=True)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--qps", type=float, default=20)
+    p.set_defaults(func=geocode)
+
+    p = sub.add_parser("connections", parents=[common],
+                       help="generate type 1/2/3 connections")
+    p.add_argument("--input", required=True, help="address table")
+    p.add_argument("--output", required=True, help="parquet, csv or xlsx")
+    p.add_argument("--provinces", default="adjoin_province.json")
+    p.add_argument("--types", type=int, nargs="+", default=[1, 2, 3])
+    p.add_argument("--hops", type=int, default=1,
+                   help="max number of borders of type 3 connections")
+    p.set_defaults(func=connections)
+
+    p = sub.add_parser("distances", parents=[common],
+                       help="direct distance of connections")
+    p.add_argument("--input", required=True, help="connection table")
+    p.add_argument("--geocoding", default="./geocoding",
+                   help="json directory or .npy geocode index")
+    p.add_argument("--output", required=True)
+    p.set_defaults(func=distances)
+
+    p = sub.add_parser("cluster", parents=[common],
+                       help="cluster dealers within a direct distance")
+    p.add_argument("--input", required=True, help="address table")
+    p.add_argument("--geocoding", default="./geocoding",
+                   help="json directory or .npy geocode index")
+    p.add_argument("--threshold", type=float, default=2, help="KM")
+    p.add_argument("--output", required=True)
+    p.set_defaults(func=cluster)
+
+    p = sub.add_parser("assign", parents=[common],
+                       help="assign dealers to their nearest feasible PDC")
+    p.add_argument("--input", required=True, help="address table")
+    p.add_argument("--geocoding", default="./geocoding",
+                   help="json directory or .npy geocode index")
+    p.add_argument("--capacities", default=None,
+                   help="table of [ID, Capacity] of PDCs, none for unlimited")
+    p.add_argument("--demand-column", default=None,
+                   help="column of dealer demand in the address table")
+    p.add_argument("--output", required=True, help="assignment table")
+    p.add_argument("--connections", default=None,
+                   help="also write type 1/2/3 connections per PDC here")
+    p.add_argument("--provinces", default="adjoin_province.json")
+    p.set_defaults(func=assign)
+
+    p = sub.add_parser("routes", parents=[common],
+                       help="fetch driving routes via baidu api")
+    p.add_argument("--input", required=True, help="distance table")
+    p.add_argument("--output", default="./routes", help="json directory")
+    p.add_argument("--types", type=int, nargs="*", default=None)
+    p.add_argument("--cache", default=None, help="sqlite route cache")
+    p.add_argument("--matrix", default=None,
+                   help="build the route matrix with this name")
+    p.add_argument("--ak", required=True)
+    p.add_argument("--workers", type=int, default=8)
+    p.add_argument("--qps", type=float, default=20)
+    p.set_defaults(func=routes)
+
+    p = sub.add_parser("impute", parents=[common],
+                       help="fill the pairs of the route matrix that are not "
+                            "queried by the detour factor")
+    p.add_argument("--matrix", required=True, help="route matrix name")
+    p.add_argument("--geocoding", default="geocoding.npy",
+                   help=".npy geocode index, see geocode --index")
+    p.add_argument("--groups", default=None,
+                   help="table of [ID, Province] to fit the factor per province")
+    p.add_argument("--holdout", type=float, default=0.1,
+                   help="ratio of queried pairs held out to report the error")
+    p.add_argument("--output", required=True, help="filled route matrix name")
+    p.set_defaults(func=impute)
+
+    p = sub.add_parser("solve", parents=[common], help="solve the CVRP")
+    p.add_argument("--matrix", required=True, help="route matrix name")
+    p.add_argument("--demands", required=True,
+                   help="table of [ID, Demand], the first row is the depot")
+    p.add_argument("--capacity", type=int, required=True)
+    p.add_argument("--vehicles", type=int, required=True)
+    p.add_argument("--time-limit", type=float, default=10, help="seconds")
+    p.add_argument("--time-windows", action="store_true",
+                   help="VRPTW with Open, Close and Service seconds columns "
+                        "of the demand table")
+    p.add_argument("--output", required=True, help="csv, xlsx or parquet")
+    p.set_defaults(func=solve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    summary = args.func(args)
+    if args.verbosity > 0:
+        json.dump(summary, sys.stdout, default=str)
+        sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Compile adjoin_province.json into an integer province adjacency index.
+
+Provinces are numbered by their position in the index, sorted by enName, so
+that position u < v has the same meaning as the name comparison that
+generate_3_conn() uses to keep one direction of each adjoint pair. The
+adjacency is a symmetric boolean scipy.sparse.csr_matrix, its indptr/indices
+are the neighbour list of each province. The index is cached as a .npz file
+next to the json and rebuilt only if the json is newer:
+    index = load_province_index("adjoin_province.json")
+    conn3 = generate_3_conn(address, index)
+    conn3_2hops = generate_3_conn(address, index.k_hop(2))
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix, identity
+
+
+class ProvinceIndex(object):
+    """
+    Province names, codes and adjacency addressed by integer position.
+    @Attr:
+        names: enName of each position
+        codes: the 'code' field of each position, e.g. 37 for Shandong
+        adjacency: n x n boolean csr_matrix, no self loop
+        encode: positions of province names, -1 if unknown
+        neighbours: positions of the adjoint provinces of a position
+        k_hop: index whose adjacency is provinces within k borders
+        pairs: adjoint position pairs (u, v) with u < v
+        to_frame: adjoint pairs as a pandas dataframe of names
+    """
+    def __init__(self, names, codes, adjacency):
+        self.names = np.asarray(names).astype(str)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.adjacency = csr_matrix(adjacency, dtype=bool)
+        self._sorter = np.argsort(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_json(cls, file):
+        """
+        @Args:
+            file: the province json with enName, code and adjoins
+        """
+        with open(file, "r", encoding="utf8") as rf:
+            provinces = json.load(rf)
+        provinces = sorted(provinces, key=lambda p: p["enName"])
+        names = [p["enName"] for p in provinces]
+        codes = [p.get("code", -1) for p in provinces]
+        position = {name: i for i, name in enumerate(names)}
+
+        rows, cols = [], []
+        for i, p in enumerate(provinces):
+            for a in p.get("adjoins") or []:
+                j = position.get(a.get("enName"))
+                if j is not None and j != i:
+                    rows.append(i)
+                    cols.append(j)
+        n = len(names)
+        adjacency = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                               shape=(n, n))
+        # The json lists most borders on both sides, make sure of it
+        return cls(names, codes, adjacency + adjacency.T)
+
+    def save(self, file):
+        np.savez(file, names=self.names, codes=self.codes,
+                 indptr=self.adjacency.indptr, indices=self.adjacency.indices)
+
+    @classmethod
+    def load(cls, file):
+        with np.load(file) as npz:
+            n = len(npz["names"])
+            adjacency = csr_matrix((np.ones(len(npz["indices"]), dtype=bool),
+                                    npz["indices"], npz["indptr"]),
+                                   shape=(n, n))
+            return cls(npz["names"], npz["codes"], adjacency)
+
+    def encode(self, names):
+        """
+        @Args:
+            names: array like of province enName
+        @Returns: int64 numpy array of positions, -1 for unknown names
+        """
+        names = np.asarray(names).astype(str)
+        pos = np.searchsorted(self.names, names, sorter=self._sorter)
+        pos = self._sorter[np.minimum(pos, len(self) - 1)]
+        return np.where(self.names[pos] == names, pos, -1)
+
+    def neighbours(self, position):
+        adj = self.adjacency
+        return adj.indices[adj.indptr[position]:adj.indptr[position + 1]]
+
+    def k_hop(self, k):
+        """
+        @Args:
+            k: max number of borders between 2 provinces, 1 is adjacency
+        @Returns: a ProvinceIndex with the same provinces
+        """
+        step = self.adjacency.astype(np.int64) + identity(len(self), dtype=np.int64,
+                                                          format="csr")
+        reach = identity(len(self), dtype=np.int64, format="csr")
+        for _ in range(k):
+            reach = reach @ step
+        reach = csr_matrix(reach > 0)
+        reach.setdiag(False)
+        reach.eliminate_zeros()
+        return ProvinceIndex(self.names, self.codes, reach)
+
+    def pairs(self):
+        """
+        @Returns: (u, v) int numpy arrays of adjoint positions with u < v
+        """
+        upper = self.adjacency.tocoo()
+        keep = upper.row < upper.col
+        order = np.lexsort((upper.col[keep], upper.row[keep]))
+        return upper.row[keep][order], upper.col[keep][order]
+
+    def to_frame(self):
+        """
+        @Returns: a pandas dataframe with columns [Province, Adjoint] of both
+            directions, the format that generate_3_conn() accepts.
+        """
+        adj = self.adjacency.tocoo()
+        return pd.DataFrame({"Province": self.names[adj.row],
+                             "Adjoint": self.names[adj.col]})
+
+
+def load_province_index(file="adjoin_province.json", cache_file=None):
+    """
+    Load the province index from the cache, build and cache it if the cache
+    does not exist or is older than the json.
+    @Args:
+        file: the province json
+        cache_file: the .npz cache, default to the json path with .npz
+    @Returns: a ProvinceIndex
+    """
+    if cache_file is None:
+        cache_file = os.path.splitext(file)[0] + ".npz"
+    if (os.path.exists(cache_file) and
+            os.path.getmtime(cache_file) >= os.path.getmtime(file)):
+        return ProvinceIndex.load(cache_file)
+    index = ProvinceIndex.from_json(file)
+    index.save(cache_file)
+    return index
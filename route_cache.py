@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache for baidu driving route requests.
+
+The same origin/destination pair could be requested several times under
+different Route_ID, e.g. after dealers are clustered, or when the coordinates
+come in as strings with different precision. The cache is keyed by the
+normalized and rounded coordinate pair instead of the Route_ID, so the daily
+quota is only spent once per pair.
+
+The cache is saved in a SQLite file, entries are evicted by TTL and by the
+max number of entries (least recently used first).
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from baidumapAPI import convert_to_float
+
+
+class RouteCache(object):
+    """
+    SQLite backed route cache.
+    @Attr:
+        get: get a cached route for an origin/destination pair
+        put: save a route for an origin/destination pair
+        evict: remove expired entries and shrink to max entries
+        hits, misses: counters of get(), hits are the saved API calls
+    """
+    def __init__(self, path, precision=5, symmetric=False, ttl=None,
+                 max_entries=None):
+        """
+        @Args:
+            path: sqlite file name, ":memory:" for a non persistent cache
+            precision: number of decimals the coordinates are rounded to,
+                5 decimals is around 1 meter
+            symmetric: if True, a cached A->B route is also used for B->A
+            ttl: seconds an entry is valid, None for never expire
+            max_entries: max number of entries kept, None for unlimited
+        """
+        self.precision = precision
+        self.symmetric = symmetric
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS route (
+                                  key TEXT PRIMARY KEY,
+                                  content TEXT NOT NULL,
+                                  created REAL NOT NULL,
+                                  accessed REAL NOT NULL)""")
+        self._conn.commit()
+
+    def _point(self, point):
+        lat, lng = point
+        return "{0:.{2}f},{1:.{2}f}".format(convert_to_float(lat),
+                                            convert_to_float(lng),
+                                            self.precision)
+
+    def key(self, origin, destination):
+        """
+        Normalized cache key of an origin/destination pair.
+        @Args:
+            origin, destination: latitude, longitude as float or string
+        """
+        return "%s;%s" % (self._point(origin), self._point(destination))
+
+    def _keys(self, origin, destination):
+        keys = [self.key(origin, destination)]
+        if self.symmetric:
+            keys.append(self.key(destination, origin))
+        return keys
+
+    def get(self, origin, destination):
+        """
+        @Returns: the cached route response, None if not cached or expired
+        """
+        now = time.time()
+        with self._lock:
+            for key in self._keys(origin, destination):
+                row = self._conn.execute(
+                    "SELECT content, created FROM route WHERE key=?",
+                    (key,)).fetchone()
+                if row is None:
+                    continue
+                if self.ttl is not None and now - row[1] > self.ttl:
+                    self._conn.execute("DELETE FROM route WHERE key=?", (key,))
+                    continue
+                self._conn.execute("UPDATE route SET accessed=? WHERE key=?",
+                                   (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return json.loads(row[0])
+            self._conn.commit()
+            self.misses += 1
+        return None
+
+    def put(self, origin, destination, route):
+        """
+        Save a route response for an origin/destination pair.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO route VALUES (?, ?, ?, ?)",
+                (self.key(origin, destination),
+                 json.dumps(route, ensure_ascii=False), now, now))
+            self._conn.commit()
+        if self.max_entries is not None and len(self) > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove the expired entries, then the least recently used entries
+        until the cache is no larger than max_entries.
+        @Returns: number of entries removed
+        """
+        removed = 0
+        with self._lock:
+            if self.ttl is not None:
+                removed += self._conn.execute(
+                    "DELETE FROM route WHERE created < ?",
+                    (time.time() - self.ttl,)).rowcount
+            if self.max_entries is not None:
+                removed += self._conn.execute(
+                    """DELETE FROM route WHERE key IN (
+                           SELECT key FROM route ORDER BY accessed DESC
+                           LIMIT -1 OFFSET ?)""",
+                    (self.max_entries,)).rowcount
+            self._conn.commit()
+        return removed
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM route").fetchone()[0]
+
+    def stats(self):
+        """
+        @Returns: a dict of hits, misses, hit_rate and entries. hits are the
+        number of API calls saved by the cache.
+        """
+        total = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self)}
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Turn the driving route json files saved by
+baidumapAPI.BaiduAPIConn.get_route_info() into a compact distance / duration
+matrix that could be used by cvrp_example.create_data_model().
+
+The verbose responses are parsed in parallel by a process pool and only
+status, distance (meter) and duration (second) are kept. Since only one
+direction of each connection is queried, the matrix is mirrored to be
+symmetric. Pairs that are not queried are set to MISSING.
+
+The matrix is saved as <name>.npy, an int32 array of shape (2, n, n) with
+distance and duration, and <name>_ids.npy with the ID of each row.
+"""
+
+import json
+import os
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+MISSING = -1
+
+
+def parse_route_file(file):
+    """
+    Read a json file that return from baidu driving api.
+    @Args: json file name
+    @Returns: (status, distance, duration), distance and duration are
+        MISSING if no route is found
+    """
+    try:
+        with open(file, 'r', encoding="utf-8-sig") as rf:
+            route = json.load(rf)
+    except (OSError, ValueError):
+        return MISSING, MISSING, MISSING
+    status = route.get("status", MISSING)
+    try:
+        best = route.get("result").get("routes")[0]
+        return status, int(best.get("distance")), int(best.get("duration"))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return status, MISSING, MISSING
+
+
+def _parse_files(files):
+    return [parse_route_file(f) for f in files]
+
+
+def load_routes(sourcepath, processes=None, chunksize=256, sep="-"):
+    """
+    Parse all route json files in source path with a process pool.
+    @Args:
+        sourcepath: a directory that has all routes saved as <Route_ID>.json,
+            Route_ID is "<ID_orig>-<ID_dest>"
+        processes: number of worker processes, None for cpu count
+        chunksize: number of files that parsed per task
+        sep: separator between ID_orig and ID_dest in Route_ID
+    @Returns:
+        a pandas dataframe with columns:
+            [Route_ID, ID_orig, ID_dest, status, distance, duration]
+    """
+    route_ids = sorted(os.path.splitext(f)[0] for f in os.listdir(sourcepath)
+                       if f.endswith(".json"))
+    files = [os.path.join(sourcepath, "%s.json" % r) for r in route_ids]
+    batches = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+
+    if processes == 1 or len(batches) <= 1:
+        parsed = [_parse_files(b) for b in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            parsed = list(executor.map(_parse_files, batches))
+    values = np.array([v for batch in parsed for v in batch],
+                      dtype=np.int64).reshape(-1, 3)
+
+    routes = pd.DataFrame({'Route_ID': route_ids})
+    ids = routes['Route_ID'].str.split(sep, n=1, expand=True)
+    routes['ID_orig'] = ids[0] if len(routes) else []
+    routes['ID_dest'] = ids[1] if len(routes) else []
+    routes['status'] = values[:, 0].astype(np.int32)
+    routes['distance'] = values[:, 1].astype(np.int32)
+    routes['duration'] = values[:, 2].astype(np.int32)
+    return routes
+
+
+def build_matrix(routes, ids=None):
+    """
+    Assemble symmetric distance and duration matrix from parsed routes.
+    @Args:
+        routes: a pandas dataframe from load_routes(), mandatory columns:
+            [ID_orig, ID_dest, distance, duration]
+        ids: the ID of matrix rows, the depot should be the first one as
+            required by cvrp_example. None for all sorted ID in routes.
+    @Returns:
+        (index, distance, duration)
+        index: a pandas Index of the ID of matrix rows
+        distance, duration: int32 n x n numpy arrays, MISSING if the pair
+            is not queried, diagonal is 0
+    """
+    routes = routes[(routes['distance'] != MISSING)]
+    if ids is None:
+        ids = np.unique(np.concatenate([routes['ID_orig'].values,
+                                        routes['ID_dest'].values]))
+    index = pd.Index(ids)
+    orig = index.get_indexer(routes['ID_orig'].values)
+    dest = index.get_indexer(routes['ID_dest'].values)
+    known = (orig >= 0) & (dest >= 0)
+    orig, dest = orig[known], dest[known]
+
+    n = len(index)
+    matrix = []
+    for col in ['distance', 'duration']:
+        m = np.full((n, n), MISSING, dtype=np.int32)
+        values = routes[col].values[known].astype(np.int32)
+        # Mirror the upper triangle, a queried direction always wins over
+        # the mirrored one.
+        m[dest, orig] = values
+        m[orig, dest] = values
+        np.fill_diagonal(m, 0)
+        matrix.append(m)
+    return index, matrix[0], matrix[1]
+
+
+def save_matrix(name, index, distance, duration):
+    """
+    Save the matrix as <name>.npy and the ID index as <name>_ids.npy.
+    """
+    np.save("%s.npy" % name, np.stack([distance, duration]).astype(np.int32))
+    np.save("%s_ids.npy" % name, np.asarray(index.values).astype(str))
+
+
+def load_matrix(name, mmap_mode='r'):
+    """
+    Load a matrix saved by save_matrix().
+    @Args:
+        name: file name without .npy
+        mmap_mode: see numpy.load, None to read into memory
+    @Returns:
+        (index, distance, duration) the same as build_matrix()
+    """
+    matrix = np.load("%s.npy" % name, mmap_mode=mmap_mode)
+    index = pd.Index(np.load("%s_ids.npy" % name))
+    return index, matrix[0], matrix[1]
+
+
+if __name__ == '__main__':
+    routes = load_routes("./routes")
+    print("%i routes, %i without distance" % (len(routes),
+                                              (routes['distance'] == MISSING).sum()))
+    index, distance, duration = build_matrix(routes)
+    save_matrix("route_matrix", index, distance, duration)
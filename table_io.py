@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Read and write connection / distance tables in a typed columnar format
+(Parquet via pyarrow) instead of Excel.
+
+The tables generated by generate_connection_table keep the coordinates as
+(latitude, longitude) tuples, which end up as "lat,lng" strings in Excel.
+Here they are split into float columns:
+    geocoding_orig -> lat_orig, lng_orig
+    geocoding_dest -> lat_dest, lng_dest
+ID and province columns are saved as categorical, and the dataset could be
+partitioned by Type and / or province. Excel is kept as an optional export.
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+from baidumapAPI import convert_to_float
+
+
+GEOCODING_COLUMNS = {"geocoding_orig": ("lat_orig", "lng_orig"),
+                     "geocoding_dest": ("lat_dest", "lng_dest")}
+CATEGORY_COLUMNS = ["ID_orig", "ID_dest", "Province", "Province_orig",
+                    "Province_dest", "Adjoint"]
+
+
+def _parse_geocode(value):
+    """
+    Parse a (latitude, longitude) tuple or "lat,lng" string.
+    @Returns: (latitude, longitude), NaN if not found
+    """
+    try:
+        if isinstance(value, str):
+            value = value.split(",")
+        lat, lng = value
+        return convert_to_float(lat), convert_to_float(lng)
+    except (TypeError, ValueError):
+        return np.nan, np.nan
+
+
+def split_geocoding(data):
+    """
+    Replace the geocoding_orig / geocoding_dest columns with float latitude,
+    longitude columns.
+    @Args:
+        data: a pandas dataframe, e.g. from calculate_direct_distance()
+    @Returns:
+        a new pandas dataframe
+    """
+    data = data.copy()
+    for col, (lat, lng) in GEOCODING_COLUMNS.items():
+        if col not in data.columns:
+            continue
+        values = np.array([_parse_geocode(v) for v in data[col].values],
+                          dtype=np.float64).reshape(-1, 2)
+        data[lat] = values[:, 0]
+        data[lng] = values[:, 1]
+        data = data.drop(columns=col)
+    return data
+
+
+def join_geocoding(data):
+    """
+    Inverse of split_geocoding(), rebuild the (latitude, longitude) columns.
+    """
+    data = data.copy()
+    for col, (lat, lng) in GEOCODING_COLUMNS.items():
+        if lat not in data.columns or lng not in data.columns:
+            continue
+        found = data[lat].notna() & data[lng].notna()
+        data[col] = [(a, b) if f else "NotFound！"
+                     for a, b, f in zip(data[lat].tolist(), data[lng].tolist(),
+                                        found.tolist())]
+        data = data.drop(columns=[lat, lng])
+    return data
+
+
+def to_typed(data):
+    """
+    Convert a connection table to the typed layout that saved on disk.
+    """
+    data = split_geocoding(data)
+    for col in CATEGORY_COLUMNS:
+        if col in data.columns:
+            data[col] = data[col].astype("category")
+    if "Type" in data.columns:
+        data["Type"] = data["Type"].astype(np.int8)
+    if "Key" in data.columns:
+        # Key is only a merge helper of generate_1_conn / generate_2_conn
+        data = data.drop(columns="Key")
+    return data
+
+
+def save_connections(data, path, partition_cols=("Type",)):
+    """
+    Save a connection or distance table as a parquet dataset.
+    @Args:
+        data: a pandas dataframe of connections
+        path: directory of the parquet dataset, or a .parquet file name if
+            partition_cols is empty
+        partition_cols: columns that the dataset is partitioned by,
+            e.g. ("Type", "Province_dest"). An existing dataset at path is
+            replaced.
+    """
+    data = to_typed(data)
+    partition_cols = [c for c in (partition_cols or []) if c in data.columns]
+    if partition_cols and os.path.isdir(path):
+        # pyarrow adds new files next to the existing ones of the dataset,
+        # a rerun would duplicate every row
+        shutil.rmtree(path)
+    data.to_parquet(path, engine="pyarrow", index=False,
+                    partition_cols=partition_cols or None)
+
+
+def load_connections(path, columns=None, filters=None, geocoding=False):
+    """
+    Load a connection table saved by save_connections().
+    @Args:
+        path: directory of the parquet dataset or a .parquet file
+        columns: list of columns to read, None for all
+        filters: pyarrow filters to read only some partitions,
+            e.g. [("Type", "=", 3)]
+        geocoding: rebuild the geocoding_orig / geocoding_dest tuple columns
+    @Returns:
+        a pandas dataframe
+    """
+    import pyarrow.dataset as ds
+
+    # Partition columns with nulls could not be read back as dictionary,
+    # so they are read as plain values and converted here.
+    data = pd.read_parquet(path, engine="pyarrow", columns=columns,
+                           filters=filters,
+                           partitioning=ds.HivePartitioning.discover(
+                               infer_dictionary=False))
+    for col in CATEGORY_COLUMNS:
+        if col in data.columns and not isinstance(data[col].dtype,
+                                                  pd.CategoricalDtype):
+            data[col] = data[col].astype("category")
+    if "Type" in data.columns:
+        data["Type"] = data["Type"].astype(np.int8)
+    if geocoding:
+        data = join_geocoding(data)
+    return data
+
+
+def export_excel(data, file):
+    """
+    Optional final export of a connection table to Excel, the coordinates are
+    written as "(lat, lng)" the same as the old Excel tables.
+    """
+    data = join_geocoding(data)
+    for col in GEOCODING_COLUMNS:
+        if col in data.columns:
+            data[col] = data[col].astype(str)
+    data.to_excel(file, index=False)